@@ -0,0 +1,316 @@
+"""
+Resources:
+    - https://docs.python.org/3/library/timeit.html
+"""
+
+from contextlib import redirect_stdout
+import argparse
+import io
+import json
+import os
+import platform
+import sys
+import time
+import numpy as np
+from ekf import code_gen, derivation, ekf, model_cache, quaternion, simulation, voting
+from geo import geo
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+REPEAT = 5
+THRESHOLD = 0.25
+BATCH = 10000
+STATE_SIZES = [1, 4, 9, 16, 24]
+
+
+# ================== MEASURING ==================
+
+
+def measure(func, number, repeat=REPEAT):
+    # Best and median of repeat runs of number calls, in seconds per call
+    func()
+
+    times = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+
+        for _ in range(number):
+            func()
+
+        times.append((time.perf_counter() - start) / number)
+
+    return {"seconds": min(times), "median": float(np.median(times)), "number": number, "repeat": repeat}
+
+
+def _quiet(func):
+    def run():
+        with redirect_stdout(io.StringIO()):
+            func()
+
+    return run
+
+
+# ================== BENCHMARKS ==================
+
+
+def bench_ekf():
+    rng = np.random.default_rng(0)
+    benchmarks = {}
+
+    for n in STATE_SIZES:
+        m = min(n, 6)
+
+        F_n = np.eye(n) + rng.normal(scale=0.01, size=(n, n))
+        Q_n = np.diag(rng.uniform(0.01, 0.1, n))
+        H_n = rng.normal(size=(m, n))
+        R_n = np.diag(rng.uniform(0.5, 2, m))
+        z = list(rng.normal(size=m))
+
+        f = lambda *args, F_n=F_n, n=n: F_n @ np.array([args[:n]]).T
+        F = lambda *args, F_n=F_n: F_n
+        Q = lambda *args, Q_n=Q_n: Q_n
+        h = lambda *args, H_n=H_n: H_n @ np.array([args]).T
+        H = lambda *args, H_n=H_n: H_n
+        R = lambda *args, R_n=R_n: R_n
+
+        filt = ekf.ExtendedKalmanFilter(np.zeros(n), 1, 0.0025, -9.80665)
+
+        # Each call starts from the same state, so thousands of calls do not drift P towards overflow or singularity
+        def reset(filt=filt, x0=filt.x.copy(), P0=filt.P.copy()):
+            filt.x[...] = x0
+            filt.P[...] = P0
+
+        def predict(filt=filt, reset=reset, f=f, F=F, Q=Q):
+            reset()
+            filt.predict([], f, F, Q, [])
+
+        def correct(filt=filt, reset=reset, z=z, h=h, H=H, R=R):
+            reset()
+            filt.correct(z, h, H, R, [])
+
+        benchmarks[f"ekf.predict.n{n}"] = (predict, 500)
+        benchmarks[f"ekf.correct.n{n}"] = (correct, 500)
+
+    # The generated altitude model, its F, Q, H and R carry dependencies, so the evaluator cache is measured here
+    with redirect_stdout(io.StringIO()):
+        handles = model_cache.load_model()
+
+    params = simulation.DEFAULT_PARAMS
+    ctrl_vars = [params["sigma_h"]]
+    meas_vars = [params["variance_gps"], params["variance_baro_height"]]
+
+    filt = ekf.ExtendedKalmanFilter([0], params["start_covariance_value"], simulation.dt, simulation.g)
+    x0 = filt.x.copy()
+    P0 = filt.P.copy()
+
+    def model(step):
+        def run():
+            filt.x = x0.copy()
+            filt.P = P0.copy()
+            step()
+
+        return run
+
+    benchmarks["ekf.predict.model"] = (model(lambda: filt.predict([], handles["f"], handles["F"], handles["Q"], ctrl_vars)), 2000)
+    benchmarks["ekf.correct.model"] = (model(lambda: filt.correct([1.5, 1.2], handles["h"], handles["H"], handles["R"], meas_vars)), 2000)
+    benchmarks["ekf.predict_step.model"] = (model(lambda: filt.predict_step([], handles["predict"], ctrl_vars)), 2000)
+    benchmarks["ekf.correct_step.model"] = (model(lambda: filt.correct_step([1.5, 1.2], handles["correct"], meas_vars)), 2000)
+
+    return benchmarks
+
+
+def bench_geo():
+    rng = np.random.default_rng(0)
+    lat = rng.uniform(44, 45, BATCH)
+    lon = rng.uniform(-73, -72, BATCH)
+    alt = rng.uniform(0, 3000, BATCH)
+
+    frame = geo.LocalFrame(44.532, -72.782, 1699)
+    ned = frame.geo_to_ned(lat, lon, alt)
+    ecef = geo.geo_to_ecef(np.radians(lat), np.radians(lon), alt)
+
+    return {
+        "geo.geo_to_ecef.scalar": (lambda: geo.geo_to_ecef(0.8527, -1.2703, 1699.0), 2000),
+        "geo.ecef_to_geo.scalar": (lambda: geo.ecef_to_geo(1345660.0, -4350891.0, 4452314.0), 1000),
+        "geo.geo_to_ned.scalar": (lambda: geo.geo_to_ned(44.532, -72.782, 1699, 44.544, -72.814, 1340), 1000),
+        "geo.ned_to_geo.scalar": (lambda: geo.ned_to_geo(44.532, -72.782, 1699, 1334.3, -2544.4, 359.96), 1000),
+        "geo.geo_to_ecef.batch": (lambda: geo.geo_to_ecef(np.radians(lat), np.radians(lon), alt), 50),
+        "geo.ecef_to_geo.batch": (lambda: geo.ecef_to_geo(*ecef), 20),
+        "geo.geo_to_ned.batch": (lambda: geo.geo_to_ned(44.532, -72.782, 1699, lat, lon, alt), 50),
+        "geo.local_frame.geo_to_ned.batch": (lambda: frame.geo_to_ned(lat, lon, alt), 50),
+        "geo.local_frame.ned_to_geo.batch": (lambda: frame.ned_to_geo(*ned), 20),
+    }
+
+
+def bench_voting():
+    rng = np.random.default_rng(0)
+    data = rng.normal(0, 10, (BATCH, 3))
+    sample = list(data[0])
+
+    sensor_voting = voting.SensorVoting([16, 16, 32], [0.01, 0.02, 0.05])
+
+    return {
+        "voting.vote": (lambda: sensor_voting.vote(sample), 5000),
+        "voting.vote_batch": (lambda: sensor_voting.vote_batch(data), 50),
+        "voting.vote_batch.outliers": (lambda: sensor_voting.vote_batch(data, 3), 20),
+    }
+
+
+def bench_quaternion():
+    rng = np.random.default_rng(0)
+    q = quaternion.quat_normalize(rng.normal(size=(BATCH, 4)))
+    v = rng.normal(size=(BATCH, 3))
+    gyro = rng.normal(size=(BATCH, 3))
+
+    return {
+        "quaternion.quat_rotate_vec.single": (lambda: quaternion.quat_rotate_vec(q[0], v[0]), 5000),
+        "quaternion.quat_rotate_vec.batch": (lambda: quaternion.quat_rotate_vec(q, v), 100),
+        "quaternion.quat_from_vecs.batch": (lambda: quaternion.quat_from_vecs(v, gyro), 100),
+        "quaternion.quat_mult.batch": (lambda: quaternion.quat_mult(q, q), 100),
+        "quaternion.integrate_gyro": (lambda: quaternion.integrate_gyro(q[0], gyro, 0.0025), 20),
+    }
+
+
+def bench_derivation():
+    with redirect_stdout(io.StringIO()):
+        model = derivation.define_model()
+
+    kernels = derivation.generate_step_kernels(model)
+    dependencies = derivation.classify_dependencies(model)
+    jobs = derivation.generate_c_jobs(model)
+
+    def write_c():
+        # Written under bench_ names next to the real outputs and removed again, also when a run is interrupted
+        try:
+            for name, kind, payload in jobs:
+                code_gen.WRITERS[kind]("bench_" + name, payload)
+        finally:
+            for name, _, _ in jobs:
+                path = os.path.join(code_gen._generated_dir(), f"bench_{name}.c")
+
+                if os.path.exists(path):
+                    os.remove(path)
+
+    return {
+        "derivation.run_derivation": (_quiet(lambda: derivation.run_derivation(False)), 1),
+        "code_gen.py_model_source": (lambda: code_gen.py_model_source(model["functions"], kernels, "bench", dependencies), 1),
+        "code_gen.write_c": (write_c, 1),
+    }
+
+
+SUITES = {
+    "ekf": bench_ekf,
+    "geo": bench_geo,
+    "voting": bench_voting,
+    "quaternion": bench_quaternion,
+    "derivation": bench_derivation,
+}
+
+
+def run(suites=None, repeat=REPEAT):
+    results = {}
+
+    for suite in suites or SUITES:
+        for name, (func, number) in SUITES[suite]().items():
+            results[name] = measure(func, number, repeat)
+
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+
+
+# ================== BASELINE ==================
+
+
+def compare(results, baseline, threshold=THRESHOLD, thresholds=None):
+    # A benchmark regresses when its median time is more than its threshold slower than the baseline,
+    # the best of a few microsecond runs swings by a third between identical runs
+    report = {}
+
+    for name, result in results["results"].items():
+        if name not in baseline["results"]:
+            report[name] = {"status": "new", "median": result["median"]}
+            continue
+
+        ratio = result["median"] / baseline["results"][name]["median"]
+        limit = (thresholds or {}).get(name, baseline.get("thresholds", {}).get(name, threshold))
+
+        if ratio > 1 + limit:
+            status = "regressed"
+        elif ratio < 1 / (1 + limit):
+            status = "improved"
+        else:
+            status = "ok"
+
+        report[name] = {"status": status, "median": result["median"], "baseline": baseline["results"][name]["median"], "ratio": ratio}
+
+    return report
+
+
+def _write_json(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+
+    with open(tmp_path, "w") as file:
+        json.dump(data, file, indent=4, sort_keys=True)
+
+    os.replace(tmp_path, path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("suites", nargs="*", help=f"suites to run, all by default: {', '.join(SUITES)}")
+    parser.add_argument("--output", help="JSON results file")
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD, help="allowed slowdown, 0.25 is 25%%")
+    parser.add_argument("--threshold-for", action="append", default=[], metavar="NAME=VALUE")
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    args = parser.parse_args()
+
+    for suite in args.suites:
+        if suite not in SUITES:
+            parser.error(f"unknown suite {suite}")
+
+    results = run(args.suites, args.repeat)
+
+    if args.output:
+        _write_json(args.output, results)
+
+    if args.update_baseline:
+        try:
+            with open(args.baseline) as file:
+                baseline = json.load(file)
+        except (OSError, ValueError):
+            baseline = {}
+
+        # Thresholds stored with the baseline survive an update
+        _write_json(args.baseline, {**results, "thresholds": baseline.get("thresholds", {})})
+
+        for name, result in results["results"].items():
+            print(f"{name:45s} {result['median'] * 1e6:12.2f} us")
+
+        sys.exit(0)
+
+    if not os.path.exists(args.baseline):
+        sys.exit(f"No baseline at {args.baseline}, create one with --update-baseline")
+
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+
+    thresholds = {name: float(value) for name, value in (x.split("=", 1) for x in args.threshold_for)}
+    report = compare(results, baseline, args.threshold, thresholds)
+
+    for name, item in report.items():
+        ratio = f"{item['ratio']:6.2f}x" if "ratio" in item else "      -"
+
+        print(f"{name:45s} {item['median'] * 1e6:12.2f} us {ratio} {item['status']}")
+
+    sys.exit(1 if any(item["status"] == "regressed" for item in report.values()) else 0)
@@ -0,0 +1,285 @@
+"""
+Resources:
+    - https://docs.python.org/3/library/ctypes.html
+    - https://numpy.org/doc/stable/reference/routines.ctypeslib.html
+"""
+
+import ctypes
+import os
+import re
+import subprocess
+import sys
+import time
+import numpy as np
+from . import code_gen, derivation, ekf, flightlog, model_cache, scheduler
+
+BUILD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "generated", "build")
+LIBRARY_NAME = "kernels.dll" if os.name == "nt" else "kernels.so"
+
+OUTPUTS = {
+    "cov": ["P_Next"],
+    "cov_packed": ["P_Next"],
+    "obs": ["H_Fusion", "K_Fusion"],
+}
+
+G = -9.80665
+DT = 0.0025
+
+
+# ================== WRAPPING ==================
+
+
+class Kernel:
+    def __init__(self, name, kind, payload):
+        matrices = [payload] if kind in ["cov", "cov_packed"] else list(payload)
+        symbols = set().union(*[m.free_symbols for m in matrices])
+
+        self.name = name
+        self.kind = kind
+        self.packed = name.endswith("_packed")
+        self.n = matrices[0].shape[1] if kind == "obs" else matrices[0].shape[0]
+        self.scalars = sorted(str(x) for x in symbols if not str(x).startswith("P["))
+        self.outputs = [(output, m.shape) for output, m in zip(OUTPUTS[kind], matrices)]
+
+        match = re.match(r"fusion_(\d+)", name)
+        self.rows = [int(match.group(1))] if match else None
+
+    def cov_size(self):
+        return self.n * (self.n + 1) // 2 if self.packed else self.n * self.n
+
+    def output_size(self, output, shape):
+        return self.cov_size() if output == "P_Next" else shape[0] * shape[1]
+
+    def c_params(self):
+        params = ["const float *P_in"]
+        params += [f"float {x}" for x in self.scalars]
+        params += [f"float *{output}_out" for output, _ in self.outputs]
+
+        return ", ".join(params)
+
+    def c_source(self, snippet):
+        lines = [f"void kernel_{self.name}({self.c_params()})", "{"]
+
+        if self.packed:
+            lines.append("    const float *P = P_in;")
+        else:
+            lines.append(f"    const float (*P)[{self.n}] = (const float (*)[{self.n}])P_in;")
+
+        # Same declarations write_matrix assumes: 1x1 results are plain scalars, vectors and packed P are flat
+        for output, shape in self.outputs:
+            if shape == (1, 1):
+                lines.append(f"    float {output};")
+            elif shape[0] == 1 or shape[1] == 1 or (output == "P_Next" and self.packed):
+                lines.append(f"    float *{output} = {output}_out;")
+            else:
+                lines.append(f"    float (*{output})[{shape[1]}] = (float (*)[{shape[1]}]){output}_out;")
+
+        lines += ["    " + line if line else "" for line in snippet.splitlines()]
+
+        for output, shape in self.outputs:
+            if shape == (1, 1):
+                lines.append(f"    {output}_out[0] = {output};")
+
+        lines.append("}")
+        lines.append("")
+
+        # Called through a volatile pointer so the compiler can not inline or hoist the kernel out of the loop
+        args = ", ".join(["P_in", *self.scalars, *[f"{output}_out" for output, _ in self.outputs]])
+        types = ", ".join(["const float *", *["float"] * len(self.scalars), *["float *"] * len(self.outputs)])
+
+        lines.append(f"void loop_{self.name}(long iterations, {self.c_params()})")
+        lines.append("{")
+        lines.append(f"    void (*volatile kernel)({types}) = kernel_{self.name};")
+        lines.append("")
+        lines.append("    for (long i = 0; i < iterations; i++)")
+        lines.append(f"        kernel({args});")
+        lines.append("}")
+
+        return "\n".join(lines) + "\n"
+
+    def bind(self, library):
+        array = np.ctypeslib.ndpointer(np.float32, flags="C_CONTIGUOUS")
+        argtypes = [array, *[ctypes.c_float] * len(self.scalars), *[array] * len(self.outputs)]
+
+        self._kernel = getattr(library, f"kernel_{self.name}")
+        self._kernel.argtypes = argtypes
+        self._kernel.restype = None
+
+        self._loop = getattr(library, f"loop_{self.name}")
+        self._loop.argtypes = [ctypes.c_long, *argtypes]
+        self._loop.restype = None
+
+    def _args(self, P, values):
+        P_in = np.ascontiguousarray(_pack(P) if self.packed else P, dtype=np.float32)
+        outputs = [np.zeros(self.output_size(output, shape), dtype=np.float32) for output, shape in self.outputs]
+
+        return [P_in, *[values[x] for x in self.scalars], *outputs], outputs
+
+    def __call__(self, P, values):
+        args, outputs = self._args(P, values)
+        self._kernel(*args)
+
+        results = []
+
+        for (output, shape), value in zip(self.outputs, outputs):
+            value = value.astype(float)
+
+            if output == "P_Next":
+                results.append(_unpack(value, self.n) if self.packed else _symmetric_from_upper(value.reshape(shape)))
+            else:
+                results.append(value.reshape(shape))
+
+        return results
+
+    def time(self, P, values, iterations):
+        args, _ = self._args(P, values)
+
+        start = time.perf_counter_ns()
+        self._loop(iterations, *args)
+
+        return (time.perf_counter_ns() - start) / iterations
+
+
+def _pack(P):
+    cols, rows = np.tril_indices(len(P))
+
+    return P[rows, cols]
+
+
+def _unpack(P, n):
+    return np.array([[P[code_gen.packed_index(i, j)] for j in range(n)] for i in range(n)])
+
+
+def _symmetric_from_upper(P):
+    return np.triu(P) + np.triu(P, 1).T
+
+
+def build_library(kernels, cc=None, build_dir=BUILD_DIR):
+    cc = cc or os.environ.get("CC", "cc")
+    source = "#include <math.h>\n\n"
+
+    for kernel in kernels:
+        with open(os.path.join(code_gen._generated_dir(), f"{kernel.name}.c")) as file:
+            source += kernel.c_source(file.read()) + "\n"
+
+    if not os.path.exists(build_dir):
+        os.makedirs(build_dir)
+
+    source_path = os.path.join(build_dir, "kernels.c")
+    library_path = os.path.join(build_dir, LIBRARY_NAME)
+
+    with open(source_path, "w") as file:
+        file.write(source)
+
+    subprocess.run([cc, "-O2", "-shared", "-fPIC", "-o", library_path, source_path, "-lm"], check=True)
+
+    library = ctypes.CDLL(library_path)
+
+    for kernel in kernels:
+        kernel.bind(library)
+
+    return library
+
+
+# ================== REPLAY ==================
+
+
+def _values(model, filt, u, ctrl_vars, meas_vars):
+    Q_args = model["functions"]["Q"][0]
+    R_args = model["functions"]["R"][0]
+
+    values = dict(zip([str(x) for x in Q_args], [*filt.x[:, 0], *u, *ctrl_vars, filt.g, filt.dt]))
+    values.update(zip([str(x) for x in R_args], meas_vars))
+
+    return values
+
+
+def _update(result, value, reference, rtol, atol):
+    error = np.abs(value - reference)
+
+    result["max_abs_error"] = max(result["max_abs_error"], float(np.max(error)))
+    result["max_tolerance_ratio"] = max(result["max_tolerance_ratio"], float(np.max(error / (atol + rtol * np.abs(reference)))))
+    result["calls"] += 1
+
+
+def replay(log_path, ctrl_vars=[1], meas_vars=[1.6, 0.9], packed=False, rtol=1e-4, atol=1e-6, iterations=100000):
+    # The C kernels are fed the Python filter's own state every step, so float32 error does not accumulate
+    model = derivation.define_model()
+    kernels = [Kernel(*job) for job in derivation.generate_c_jobs(model, packed)]
+    handles = model_cache.load_model()
+
+    build_library(kernels)
+
+    cov = [k for k in kernels if k.kind != "obs"][0]
+    fusions = [k for k in kernels if k.kind == "obs"]
+    sensors = {"gps": [0], "baro": [1]}
+
+    meas = flightlog.altitude_measurements(flightlog.load_flight_log(log_path))
+    z = {"gps": meas["gps_height"], "baro": meas["baro_height"]}
+
+    filt = ekf.ExtendedKalmanFilter([0], 1, DT, G)
+    selected = {name: scheduler.select_measurements(handles["h"], handles["H"], handles["R"], rows) for name, rows in sensors.items()}
+    results = {k.name: {"calls": 0, "max_abs_error": 0.0, "max_tolerance_ratio": 0.0} for k in kernels}
+    samples = {}
+
+    for i in range(len(meas["t"])):
+        values = _values(model, filt, [], ctrl_vars, meas_vars)
+        P_prior = filt.P.copy()
+
+        (P_next,) = cov(P_prior, values)
+        filt.predict([], handles["f"], handles["F"], handles["Q"], ctrl_vars)
+
+        _update(results[cov.name], P_next, filt.P, rtol, atol)
+        samples.setdefault(cov.name, (P_prior, values))
+
+        for name, rows in sensors.items():
+            if not meas[f"{name}_fresh"][i]:
+                continue
+
+            for kernel in fusions:
+                if kernel.rows is not None and kernel.rows != rows:
+                    continue
+
+                h, H, R = selected[name]
+                values = _values(model, filt, [], ctrl_vars, meas_vars)
+                x_prior, P_prior = filt.x.copy(), filt.P.copy()
+
+                H_c, K_c = kernel(P_prior, values)
+                K_c = K_c.reshape(len(x_prior), -1)
+
+                # Joseph update from the C gain, compared against the filter's own correction
+                I_KH = np.eye(len(x_prior)) - K_c @ H_c
+                x_c = x_prior + K_c @ (np.array([[z[name][i]]]) - h(*x_prior[:, 0]))
+                P_c = I_KH @ P_prior @ I_KH.T + K_c @ R(*meas_vars) @ K_c.T
+
+                filt.correct([z[name][i]], h, H, R, meas_vars)
+
+                _update(results[kernel.name], x_c, filt.x, rtol, atol)
+                _update(results[kernel.name], P_c, filt.P, rtol, atol)
+                samples.setdefault(kernel.name, (P_prior, values))
+
+    for kernel in kernels:
+        if kernel.name in samples:
+            results[kernel.name]["ns_per_step"] = kernel.time(*samples[kernel.name], iterations)
+
+    return results
+
+
+if __name__ == "__main__":
+    args = [x for x in sys.argv[1:] if not x.startswith("--")]
+    log_path = args[0] if args else "./ekf/data/flightlog3.csv"
+
+    results = replay(log_path, packed="--packed" in sys.argv)
+    failed = False
+
+    for name, result in results.items():
+        ok = result["calls"] > 0 and result["max_tolerance_ratio"] <= 1
+
+        failed = failed or not ok
+
+        print(
+            f"{name}: {'ok' if ok else 'FAIL'}, {result['calls']} checks, "
+            f"max abs error {result['max_abs_error']:.3e}, {result.get('ns_per_step', float('nan')):.1f} ns/step"
+        )
+
+    sys.exit(1 if failed else 0)
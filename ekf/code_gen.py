@@ -3,9 +3,16 @@ Resources:
     - https://github.com/PX4/PX4-ECL/blob/master/EKF/python/ekf_derivation/code_gen.py
 """
 
-from sympy import ccode, cse, symbols, Matrix
+from concurrent.futures import ProcessPoolExecutor
+from sympy import ccode, cse, numbered_symbols, srepr, Matrix, Symbol
 from sympy.codegen.ast import float32, real
+from sympy.printing.numpy import NumPyPrinter
+import hashlib
+import json
 import os
+import time
+
+MANIFEST_FILE = "manifest.json"
 
 
 class CodeGenerator:
@@ -27,52 +34,249 @@ class CodeGenerator:
         return ccode(expression, type_aliases={real: float32})
 
     def write_subexpressions(self, subexpressions):
-        write_string = ""
-
         for item in subexpressions:
-            write_string = write_string + "const float " + str(item[0]) + " = " + self.get_ccode(item[1]) + ";\n"
-
-        write_string = write_string + "\n\n"
-        self.file.write(write_string)
+            self.file.write("const float " + str(item[0]) + " = " + self.get_ccode(item[1]) + ";\n")
 
-    def write_matrix(self, matrix, variable_name, is_symmetric=False, pre_bracket="[", post_bracket="]", separator="]["):
-        write_string = ""
+        self.file.write("\n\n")
 
+    def write_matrix(self, matrix, variable_name, is_symmetric=False, pre_bracket="[", post_bracket="]", separator="][", is_packed=False):
         if matrix.shape[0] * matrix.shape[1] == 1:
-            write_string = write_string + variable_name + " = " + self.get_ccode(matrix[0]) + ";\n"
+            self.file.write(variable_name + " = " + self.get_ccode(matrix[0]) + ";\n")
         elif matrix.shape[0] == 1 or matrix.shape[1] == 1:
             for i in range(0, len(matrix)):
-                write_string = write_string + variable_name + pre_bracket + str(i) + post_bracket + " = " + self.get_ccode(matrix[i]) + ";\n"
+                self.file.write(variable_name + pre_bracket + str(i) + post_bracket + " = " + self.get_ccode(matrix[i]) + ";\n")
         else:
             for j in range(0, matrix.shape[1]):
                 for i in range(0, matrix.shape[0]):
-                    if j >= i or not is_symmetric:
-                        write_string = write_string + variable_name + pre_bracket + str(i) + separator + str(j) + post_bracket + " = " + self.get_ccode(matrix[i, j]) + ";\n"
+                    if is_symmetric and is_packed and j >= i:
+                        self.file.write(variable_name + pre_bracket + str(packed_index(i, j)) + post_bracket + " = " + self.get_ccode(matrix[i, j]) + ";\n")
+                    elif j >= i or not is_symmetric:
+                        self.file.write(variable_name + pre_bracket + str(i) + separator + str(j) + post_bracket + " = " + self.get_ccode(matrix[i, j]) + ";\n")
 
-        write_string = write_string + "\n\n"
-
-        self.file.write(write_string)
+        self.file.write("\n\n")
 
     def close(self):
         self.file.close()
 
 
-def write_cov_matrix(name, P):
-    P_new = cse(P, symbols("PS0:1000"), optimizations="basic")
+def _timed(timings, stage, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    timings[stage] = timings.get(stage, 0) + time.perf_counter() - start
+
+    return result
+
+
+def packed_index(i, j):
+    # Column-major upper triangle, the order write_matrix already emits symmetric entries in
+    i, j = min(i, j), max(i, j)
+
+    return i + j * (j + 1) // 2
+
+
+def write_cov_matrix(name, P, timings=None, packed=False):
+    timings = {} if timings is None else timings
+    P_new = _timed(timings, "cse", cse, P, numbered_symbols("PS"), "basic")
 
     gen = CodeGenerator(f"{name}.c")
-    gen.write_subexpressions(P_new[0])
-    gen.write_matrix(Matrix(P_new[1]), "P_Next", True)
+    _timed(timings, "print", gen.write_subexpressions, P_new[0])
+    _timed(timings, "print", gen.write_matrix, Matrix(P_new[1]), "P_Next", True, "[", "]", "][", packed)
     gen.close()
 
+    return timings
+
+
+def write_packed_cov_matrix(name, P, timings=None):
+    return write_cov_matrix(name, P, timings, True)
+
+
+def write_obs_eqs(name, HK, timings=None):
+    timings = {} if timings is None else timings
+    H = _timed(timings, "cse", cse, HK[0], numbered_symbols("HS"), "basic")
+    K = _timed(timings, "cse", cse, HK[1], numbered_symbols("KS"), "basic")
+
+    gen = CodeGenerator(f"{name}.c")
+    _timed(timings, "print", gen.write_subexpressions, H[0])
+    _timed(timings, "print", gen.write_matrix, H[1][0], "H_Fusion")
+    _timed(timings, "print", gen.write_subexpressions, K[0])
+    _timed(timings, "print", gen.write_matrix, K[1][0], "K_Fusion")
+    gen.close()
+
+    return timings
+
+
+def write_steady_state(name, payload, timings=None):
+    timings = {} if timings is None else timings
+    state_vector, f, gains = payload
 
-def write_obs_eqs(name, HK):
-    H = cse(HK[0], symbols("HS0:1000"), optimizations="basic")
-    K = cse(HK[1], symbols("KS0:1000"), optimizations="basic")
-    
     gen = CodeGenerator(f"{name}.c")
-    gen.write_subexpressions(H[0])
-    gen.write_matrix(H[1][0], "H_Fusion")
-    gen.write_subexpressions(K[0])
-    gen.write_matrix(K[1][0], "K_Fusion")
+    gen.print_string("Fixed-gain filter, x_Correct uses the state after x_Predict")
+    _timed(timings, "print", gen.write_matrix, f, "x_Predict")
+
+    for suffix, h, K in gains:
+        meas = Matrix(h.shape[0], 1, lambda i, j: Symbol("meas[" + str(i) + "]", real=True))
+
+        _timed(timings, "print", gen.write_matrix, K, "K_Steady" + suffix)
+        _timed(timings, "print", gen.write_matrix, state_vector + K * (meas - h), "x_Correct" + suffix)
+
     gen.close()
+
+    return timings
+
+
+# ================== PIPELINE ==================
+
+
+WRITERS = {
+    "cov": write_cov_matrix,
+    "cov_packed": write_packed_cov_matrix,
+    "obs": write_obs_eqs,
+    "steady_state": write_steady_state,
+}
+
+
+def _generated_dir():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), "generated")
+
+
+def _job_hash(kind, payload):
+    digest = hashlib.sha256(kind.encode())
+
+    with open(os.path.abspath(__file__), "rb") as file:
+        digest.update(file.read())
+
+    digest.update(srepr(payload).encode())
+
+    return digest.hexdigest()
+
+
+def _read_manifest():
+    try:
+        with open(os.path.join(_generated_dir(), MANIFEST_FILE)) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_manifest(manifest):
+    with open(os.path.join(_generated_dir(), MANIFEST_FILE), "w") as file:
+        json.dump(manifest, file, indent=4, sort_keys=True)
+
+
+def _run_job(job):
+    name, kind, payload = job
+
+    return name, WRITERS[kind](name, payload)
+
+
+def run_pipeline(jobs, processes=None, force=False):
+    # Each job is an independent output file, so CSE and printing run in separate worker processes
+    manifest = _read_manifest()
+    pending = []
+    hashes = {}
+
+    for name, kind, payload in jobs:
+        start = time.perf_counter()
+        hashes[name] = _job_hash(kind, payload)
+        hash_time = time.perf_counter() - start
+
+        if not force and manifest.get(name) == hashes[name] and os.path.exists(os.path.join(_generated_dir(), f"{name}.c")):
+            print(f"{name}: unchanged, skipped (hash {hash_time:.3f}s)")
+        else:
+            pending.append((name, kind, payload))
+
+    if len(pending) > 1 and processes != 1:
+        with ProcessPoolExecutor(processes) as pool:
+            results = list(pool.map(_run_job, pending))
+    else:
+        results = [_run_job(job) for job in pending]
+
+    for name, timings in results:
+        manifest[name] = hashes[name]
+
+        print(f"{name}: " + ", ".join(f"{stage} {seconds:.3f}s" for stage, seconds in timings.items()))
+
+    _write_manifest(manifest)
+
+    return results
+
+
+def _py_kernel_source(name, params, unpack, stages, outputs, printer):
+    cse_symbols = numbered_symbols("KS")
+
+    lines = [f"def {name}({', '.join(params)}):"]
+    lines += [f"    {symbol} = {source}" for symbol, source in unpack]
+
+    for targets, expressions in stages:
+        subexpressions, reduced = cse(expressions, cse_symbols, optimizations="basic")
+        assigned = set()
+
+        lines += [f"    {item[0]} = {printer.doprint(item[1])}" for item in subexpressions]
+
+        for target, expression in zip(targets, reduced[0]):
+            if target not in assigned:
+                assigned.add(target)
+                lines.append(f"    {target} = {printer.doprint(expression)}")
+
+    subexpressions, outputs = cse(outputs, cse_symbols, optimizations="basic")
+
+    lines += [f"    {item[0]} = {printer.doprint(item[1])}" for item in subexpressions]
+    lines.append("    return " + ", ".join(printer.doprint(x) for x in outputs))
+
+    return "\n".join(lines) + "\n"
+
+
+def _py_dependency_source(name, arg_names, dependency, printer):
+    # Attached to the function, so ExtendedKalmanFilter can cache matrices that do not depend on the state
+    lines = [f"{name}.kind = \"{dependency['kind']}\"", f"{name}.depends = {dependency['depends']}"]
+    bodies = []
+
+    if "blocks" in dependency:
+        blocks = []
+
+        for i, (kind, depends, entries) in enumerate(dependency["blocks"]):
+            rows = tuple(entry[0] for entry in entries)
+            cols = tuple(entry[1] for entry in entries)
+            values = Matrix([[entry[2] for entry in entries]])
+
+            bodies.append(f"def {name}_block{i}({arg_names}):\n    return {printer.doprint(values)}\n")
+            blocks.append(f"(\"{kind}\", {depends}, {rows}, {cols}, {name}_block{i})")
+
+        lines.append(f"{name}.shape = {dependency['shape']}")
+        lines.append(f"{name}.blocks = [{', '.join(blocks)}]")
+
+    return bodies, "\n".join(lines) + "\n"
+
+
+def py_model_source(functions, kernels, model_hash, dependencies=None):
+    printer = NumPyPrinter({"fully_qualified_modules": False, "inline": True})
+    bodies = []
+
+    for name, (args, expression) in functions.items():
+        arg_names = ", ".join(str(x) for x in args)
+
+        bodies.append(f"def {name}({arg_names}):\n    return {printer.doprint(expression)}\n")
+
+        if dependencies is not None and name in dependencies:
+            block_bodies, annotations = _py_dependency_source(name, arg_names, dependencies[name], printer)
+
+            bodies += block_bodies
+            bodies.append(annotations)
+
+    for name, (params, unpack, stages, outputs) in kernels.items():
+        bodies.append(_py_kernel_source(name, params, unpack, stages, outputs, printer))
+
+    imports = sorted(printer.module_imports.get("numpy", set()))
+
+    source = "# Generated by ekf.code_gen, do not edit\n"
+    source += f"from numpy import {', '.join(imports)}\n\n"
+    source += f"MODEL_HASH = \"{model_hash}\"\n"
+    source += f"FUNCTIONS = {[*functions.keys(), *kernels.keys()]}\n\n\n"
+    source += "\n\n".join(bodies)
+
+    return source
+
+
+def write_py_model(file_path, functions, kernels, model_hash, dependencies=None):
+    with open(file_path, "w") as file:
+        file.write(py_model_source(functions, kernels, model_hash, dependencies))
@@ -1,5 +1,11 @@
+import hashlib
+import sys
+import numpy as np
 from sympy import *
-from . import code_gen
+from . import code_gen, ekf
+
+# State-dependent matrices with at least this many entries are split into blocks by dependency
+BLOCK_MIN_ENTRIES = 16
 
 
 def _quat_to_rot(q):
@@ -46,21 +52,172 @@ def _create_cov_matrix(n):
     return Matrix(n, n, _create_cov_matrix_entry)
 
 
+def _create_py_cov_matrix_entry(i, j):
+    return Symbol("P[" + str(min(i, j)) + ", " + str(max(i, j)) + "]", real=True)
+
+
+def _create_py_cov_matrix(n):
+    return Matrix(n, n, _create_py_cov_matrix_entry)
+
+
+def _create_packed_cov_matrix(n):
+    return Matrix(n, n, lambda i, j: Symbol("P[" + str(code_gen.packed_index(i, j)) + "]", real=True))
+
+
+def _pack_upper(m):
+    return Matrix([m[i, j] for j in range(m.shape[1]) for i in range(j + 1)])
+
+
+def _create_meas_vector(m):
+    return Matrix(m, 1, lambda i, j: Symbol("meas[" + str(i) + "]", real=True))
+
+
+def _symmetric_from_upper(m):
+    return Matrix(m.shape[0], m.shape[1], lambda i, j: m[min(i, j), max(i, j)])
+
+
 def generate_observation_equations(P, H, R):
     K = P * H.T * (H * P * H.T + R).inv()
 
     return H, K
 
 
+def generate_sequential_observation_equations(P, H, R):
+    # Valid for diagonal R, each scalar fusion only divides by its own innovation variance
+    HK = []
+
+    for i in range(H.shape[0]):
+        H_i = H[i, :]
+        K_i = P * H_i.T / ((H_i * P * H_i.T)[0, 0] + R[i, i])
+
+        HK.append((H_i, K_i))
+
+    return HK
+
+
 def generate_cov_prediction(P, F, Q):
     P_new = F * P * F.T + Q
 
     return P_new
 
 
-def run_derivation(generate_eqs):
-    print("Starting derivation...")
+def _create_stage_matrix(name, rows, cols, symmetric=False):
+    def entry(i, j):
+        if symmetric:
+            i, j = min(i, j), max(i, j)
+
+        return Symbol(name + str(i) + "_" + str(j), real=True)
+
+    return Matrix(rows, cols, entry)
+
+
+def generate_step_kernels(model):
+    n = model["state_vector"].shape[0]
+
+    kernels = _generate_step_kernels(model, _create_py_cov_matrix(n), _symmetric_from_upper)
+
+    # Same kernels on the packed upper-triangular layout used by the generated C
+    for name, kernel in _generate_step_kernels(model, _create_packed_cov_matrix(n), _pack_upper).items():
+        kernels[name + "_packed"] = kernel
+
+    return kernels
+
+
+def _generate_step_kernels(model, P, output_cov):
+    state_vector = model["state_vector"]
+    n = state_vector.shape[0]
+
+    _, f = model["functions"]["f"]
+    _, F = model["functions"]["F"]
+    Q_args, Q = model["functions"]["Q"]
+    _, h = model["functions"]["h"]
+    _, H = model["functions"]["H"]
+    R_args, R = model["functions"]["R"]
+
+    m = h.shape[0]
+
+    meas = _create_meas_vector(m)
+    unpack = [(str(state_vector[i]), "x[" + str(i) + ", 0]") for i in range(n)]
+
+    P_next = output_cov(generate_cov_prediction(P, F, Q))
+
+    # Staged so the symbolic inverse only sees the m x m innovation covariance symbols
+    S = _create_stage_matrix("IS", m, m, True)
+    S_inv = _create_stage_matrix("ISI", m, m, True)
+    K = _create_stage_matrix("KG", n, m)
+
+    x_new = state_vector + K * (meas - h)
+    I_KH = eye(n) - K * H
+    P_new = output_cov(I_KH * P * I_KH.T + K * R * K.T)
+
+    correct_stages = [
+        (S, H * P * H.T + R),
+        (S_inv, S.inv()),
+        (K, P * H.T * S_inv),
+    ]
+
+    correct_params = ["x", "P", "meas", *[str(x) for x in R_args]]
+
+    kernels = {
+        "predict": (["x", "P", *[str(x) for x in Q_args[n:]]], unpack, [], [f, P_next]),
+        "correct": (correct_params, unpack, correct_stages, [x_new, P_new]),
+    }
+
+    if R.is_diagonal():
+        sequential_stages, sequential_outputs = _generate_sequential_stages(state_vector, P, meas - h, H, R, output_cov)
+        kernels["correct_sequential"] = (correct_params, unpack, sequential_stages, sequential_outputs)
+
+        # One kernel per measurement for sensors fused on their own, also returning the innovation and its variance
+        for i in range(m):
+            H_i = H[i, :]
+            S_i = _create_stage_matrix("IS", 1, 1)
+            K_i = _create_stage_matrix("KG", n, 1)
+            y_i = Matrix([meas[0] - h[i]])
+
+            I_KH = eye(n) - K_i * H_i
+            P_i = output_cov(I_KH * P * I_KH.T + K_i * R[i, i] * K_i.T)
+
+            stages = [
+                (S_i, H_i * P * H_i.T + Matrix([R[i, i]])),
+                (K_i, P * H_i.T / S_i[0, 0]),
+            ]
+
+            kernels[f"correct_{i}"] = (correct_params, unpack, stages, [state_vector + K_i * y_i, P_i, y_i, S_i])
+
+    return kernels
+
+
+def _generate_sequential_stages(state_vector, P, innovation, H, R, output_cov):
+    n = state_vector.shape[0]
+    m = H.shape[0]
+
+    stages = []
+    x_i = state_vector
+    P_i = P
+
+    for i in range(m):
+        H_i = H[i, :]
+        S_i = _create_stage_matrix("SS" + str(i) + "_", 1, 1)
+        K_i = _create_stage_matrix("KG" + str(i) + "_", n, 1)
+
+        stages.append((S_i, H_i * P_i * H_i.T + Matrix([R[i, i]])))
+        stages.append((K_i, P_i * H_i.T / S_i[0, 0]))
+
+        I_KH = eye(n) - K_i * H_i
+        x_next = x_i + K_i * (innovation[i] - (H_i * (x_i - state_vector))[0, 0])
+        P_next = I_KH * P_i * I_KH.T + K_i * R[i, i] * K_i.T
+
+        if i < m - 1:
+            x_i = _create_stage_matrix("XU" + str(i) + "_", n, 1)
+            P_i = _create_stage_matrix("PU" + str(i) + "_", n, n, True)
+
+            stages.append((x_i, x_next))
+            stages.append((P_i, _symmetric_from_upper(P_next)))
 
+    return stages, [x_next, output_cov(P_next)]
+
+
+def define_model():
     dt, g = symbols("dt, g")
 
     print("Setting State Vector...")
@@ -114,16 +271,151 @@ def run_derivation(generate_eqs):
 
     R = Matrix.diag(*meas_variance_vector)
 
+    return {
+        "state_vector": state_vector,
+        "functions": {
+            "f": ([*state_vector, g, dt], f),
+            "F": ([*state_vector, g, dt], F),
+            "Q": ([*state_vector, var_h, g, dt], Q),
+            "h": ([*state_vector], h),
+            "H": ([*state_vector], H),
+            "R": ([var_gps, var_baro], R),
+        },
+    }
+
+
+def _dependency(args, expression, states):
+    free = expression.free_symbols
+
+    if free & states:
+        kind = "state"
+    elif any(str(x) == "dt" for x in free):
+        kind = "dt"
+    else:
+        kind = "constant"
+
+    return kind, tuple(i for i, x in enumerate(args) if x in free)
+
+
+def classify_dependencies(model):
+    # How often each function has to be evaluated: constant ones once per set of parameters (g, noise variances),
+    # dt-dependent ones whenever the time step changes and state-dependent ones every step
+    states = set(model["state_vector"])
+    dependencies = {}
+
+    for name, (args, expression) in model["functions"].items():
+        kind, depends = _dependency(args, expression, states)
+        dependencies[name] = {"kind": kind, "depends": depends}
+
+        if kind != "state" or name in ["f", "h"] or len(expression) < BLOCK_MIN_ENTRIES:
+            continue
+
+        blocks = {}
+
+        for i in range(expression.shape[0]):
+            for j in range(expression.shape[1]):
+                block_kind, block_depends = _dependency(args, expression[i, j], states)
+                block = blocks.setdefault(block_kind, (set(), []))
+
+                block[0].update(block_depends)
+                block[1].append((i, j, expression[i, j]))
+
+        if len(blocks) > 1:
+            dependencies[name]["shape"] = expression.shape
+            dependencies[name]["blocks"] = [(kind, tuple(sorted(depends)), entries) for kind, (depends, entries) in blocks.items()]
+
+    return dependencies
+
+
+def model_hash(model):
+    description = srepr(model["state_vector"])
+
+    for name, (args, expression) in sorted(model["functions"].items()):
+        description += "\n" + name + ":" + srepr(args) + ":" + srepr(expression)
+
+    return hashlib.sha256(description.encode()).hexdigest()
+
+
+def generate_c_jobs(model, packed=False):
+    state_vector = model["state_vector"]
+    F = model["functions"]["F"][1]
+    Q = model["functions"]["Q"][1]
+    H = model["functions"]["H"][1]
+    R = model["functions"]["R"][1]
+
+    if packed:
+        P = _create_packed_cov_matrix(state_vector.shape[0])
+        suffix = "_packed"
+    else:
+        P = _create_cov_matrix(state_vector.shape[0])
+        suffix = ""
+
+    jobs = [("cov" + suffix, "cov" + suffix, generate_cov_prediction(P, F, Q))]
+
+    if R.is_diagonal():
+        for i, HK in enumerate(generate_sequential_observation_equations(P, H, R)):
+            jobs.append((f"fusion_{i}{suffix}", "obs", HK))
+    else:
+        jobs.append(("fusion" + suffix, "obs", generate_observation_equations(P, H, R)))
+
+    return jobs
+
+
+def is_lti(model):
+    # Linear time-invariant when no matrix depends on the state, f is affine and h is linear in the state
+    state_vector = model["state_vector"]
+    states = set(state_vector)
+    functions = {name: expression for name, (_, expression) in model["functions"].items()}
+
+    if any(functions[name].free_symbols & states for name in ["F", "Q", "H", "R"]):
+        return False
+
+    f_rest = simplify(functions["f"] - functions["F"] * state_vector)
+    h_rest = simplify(functions["h"] - functions["H"] * state_vector)
+
+    return not (f_rest.free_symbols & states) and h_rest.is_zero_matrix
+
+
+def generate_steady_state(model, values):
+    # Gains are numeric, so they are solved for one set of noise parameters and time step
+    functions = {name: expression for name, (_, expression) in model["functions"].items()}
+    matrices = {name: functions[name] for name in ["F", "Q", "H", "R"]}
+
+    symbols = set().union(*[m.free_symbols for m in matrices.values()])
+    missing = sorted(str(x) for x in symbols if str(x) not in values)
+
+    if missing:
+        raise ValueError(f"Steady-state gain needs values for: {', '.join(missing)}")
+
+    F, Q, H, R = [np.array(m.subs({x: values[str(x)] for x in symbols}), dtype=float) for m in matrices.values()]
+
+    m = H.shape[0]
+    row_sets = [list(range(m))] + ([[i] for i in range(m)] if functions["R"].is_diagonal() and m > 1 else [])
+    gains = []
+
+    for rows in row_sets:
+        K, _ = ekf.steady_state_gain(F, Q, H[rows, :], R[np.ix_(rows, rows)])
+        suffix = "" if len(rows) == m else "_" + "_".join(str(i) for i in rows)
+
+        gains.append((suffix, functions["h"].extract(rows, [0]), Matrix(K)))
+
+    return model["state_vector"], functions["f"], gains
+
+
+def run_derivation(generate_eqs, packed=False, steady_state=None):
+    print("Starting derivation...")
+
+    model = define_model()
+
     if not generate_eqs:
         print("Lambdifing functions...")
 
-        functions_handles = {}
-        functions_handles["f"] = lambdify([*state_vector, g, dt], f)
-        functions_handles["F"] = lambdify([*state_vector, g, dt], F)
-        functions_handles["Q"] = lambdify([*state_vector, var_h, g, dt], Q)
-        functions_handles["h"] = lambdify([*state_vector], h)
-        functions_handles["H"] = lambdify([*state_vector], H)
-        functions_handles["R"] = lambdify([var_gps, var_baro], R)
+        source = code_gen.py_model_source(model["functions"], generate_step_kernels(model), model_hash(model), classify_dependencies(model))
+        namespace = {}
+
+        exec(compile(source, "<ekf model>", "exec"), namespace)
+
+        functions_handles = {name: namespace[name] for name in namespace["FUNCTIONS"]}
 
         print("Done!")
 
@@ -131,13 +423,21 @@ def run_derivation(generate_eqs):
     else:
         print("Generating equations...")
 
-        P = _create_cov_matrix(state_vector.shape[0])
+        jobs = generate_c_jobs(model, packed)
+
+        if steady_state is not None:
+            if is_lti(model):
+                jobs.append(("steady_state", "steady_state", generate_steady_state(model, steady_state)))
+            else:
+                print("Model is not linear time-invariant, no steady-state gain")
 
-        code_gen.write_cov_matrix("cov", generate_cov_prediction(P, F, Q))
-        code_gen.write_obs_eqs("fusion", generate_observation_equations(P, H, R))
+        code_gen.run_pipeline(jobs)
 
         print("Done!")
 
 
 if __name__ == "__main__":
-    run_derivation(True)
+    # --steady-state takes the parameter values as name=value, e.g. sigma_h=1 R_GPS=1.6 R_BARO=0.9
+    steady_state = {x.split("=")[0]: float(x.split("=")[1]) for x in sys.argv[1:] if "=" in x} if "--steady-state" in sys.argv else None
+
+    run_derivation(True, "--packed" in sys.argv, steady_state)
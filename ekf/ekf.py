@@ -1,18 +1,40 @@
+import types
 import numpy as np
 from . import quaternion
 
+# Cached evaluations per matrix, enough distinct time steps for a jittering clock
+MATRIX_CACHE_SIZE = 64
+# Matrix functions with an evaluator per filter, the oldest is dropped so per-call closures cannot pile up
+MATRIX_FUNCTIONS = 32
+
 
 class ExtendedKalmanFilter:
-    def __init__(self, x0, P0_value, dt, g):
+    def __init__(self, x0, P0_value, dt, g, packed=False):
         self.x = np.array([x0], dtype=float).T
         self.P = np.eye(len(x0), dtype=float) * P0_value
         self.dt = dt
         self.g = g
+        self.packed = packed
+
+        self._matrix_cache = {}
+
+        if packed:
+            # Upper triangle packed column by column, the layout of the generated *_packed.c files
+            n = len(x0)
+            cols, rows = np.tril_indices(n)
+
+            self._packed_index = (rows, cols)
+            self._dense_index = np.empty((n, n), dtype=np.intp)
+            self._dense_index[rows, cols] = np.arange(len(rows))
+            self._dense_index[cols, rows] = np.arange(len(rows))
+            self.P = self.P[self._packed_index]
 
     def predict(self, u, f, F, Q, ctrl_vars):
+        self._unpack_cov()
+
         calc_f = f(*self.x[:, 0], *u, self.g, self.dt)
-        calc_F = F(*self.x[:, 0], *u, self.g, self.dt)
-        calc_Q = Q(*self.x[:, 0], *u, *ctrl_vars, self.g, self.dt)
+        calc_F = self._evaluate(F, (*self.x[:, 0], *u, self.g, self.dt))
+        calc_Q = self._evaluate(Q, (*self.x[:, 0], *u, *ctrl_vars, self.g, self.dt))
 
         self.x = calc_f
         self.P = calc_F @ self.P @ calc_F.T + calc_Q
@@ -23,9 +45,11 @@ class ExtendedKalmanFilter:
     def correct(self, z, h, H, R, meas_vars):
         z = np.array([z]).T
 
+        self._unpack_cov()
+
         calc_h = h(*self.x[:, 0])
-        calc_H = H(*self.x[:, 0])
-        calc_R = R(*meas_vars)
+        calc_H = self._evaluate(H, tuple(self.x[:, 0]))
+        calc_R = self._evaluate(R, tuple(meas_vars))
 
         PH_ = self.P @ calc_H.T
         K = PH_ @ np.linalg.inv(calc_H @ PH_ + calc_R)
@@ -36,12 +60,307 @@ class ExtendedKalmanFilter:
         #self._normalize_quat()
         self._force_cov_symmetry()
 
+    def correct_sequential(self, z, h, H, R, meas_vars):
+        # Requires a diagonal R, fuses one scalar measurement at a time around the prior linearization
+        self._unpack_cov()
+
+        calc_h = h(*self.x[:, 0])
+        calc_H = self._evaluate(H, tuple(self.x[:, 0]))
+        calc_R = self._evaluate(R, tuple(meas_vars))
+
+        x0 = self.x
+
+        for i in range(len(z)):
+            H_i = calc_H[i : i + 1, :]
+            R_i = calc_R[i, i]
+
+            PH_ = self.P @ H_i.T
+            K = PH_ / ((H_i @ PH_)[0, 0] + R_i)
+            self.x = self.x + K * (z[i] - calc_h[i, 0] - (H_i @ (self.x - x0))[0, 0])
+            I_KH = np.eye(len(self.x)) - K @ H_i
+            self.P = I_KH @ self.P @ I_KH.T + R_i * (K @ K.T)
+
+        #self._normalize_quat()
+        self._force_cov_symmetry()
+
+    def _evaluate(self, func, args):
+        # Generated model functions carry their dependencies (derivation.classify_dependencies), anything else
+        # is treated as state-dependent and called every time
+        if func not in self._matrix_cache:
+            if len(self._matrix_cache) >= MATRIX_FUNCTIONS:
+                del self._matrix_cache[next(iter(self._matrix_cache))]
+
+            self._matrix_cache[func] = _matrix_evaluator(func)
+
+        return self._matrix_cache[func](args)
+
+    def predict_step(self, u, predict, ctrl_vars):
+        self.x, self.P = predict(self.x, self.P, *u, *ctrl_vars, self.g, self.dt)
+
+        if self.packed:
+            self.P = self.P.reshape(-1)
+
+    def correct_step(self, z, correct, meas_vars):
+        # Per-measurement kernels (correct_<i>) also return the innovation and its variance
+        self.x, self.P, *innovation = correct(self.x, self.P, z, *meas_vars)
+
+        if self.packed:
+            self.P = self.P.reshape(-1)
+
+        return innovation
+
+    def dense_cov(self):
+        return self.P[self._dense_index] if self.packed else self.P
+
+    def _unpack_cov(self):
+        if self.packed:
+            self.P = self.P[self._dense_index]
+
     def _normalize_quat(self):
         self.x[0:4, 0] = quaternion.quat_normalize(self.x[0:4, 0])
 
     def _force_cov_symmetry(self):
-        for i in range(len(self.P)):
-            for j in range(i):
-                tmp = (self.P[i, j] + self.P[j, i]) / 2
-                self.P[i, j] = tmp
-                self.P[j, i] = tmp
+        # Packing keeps only the upper triangle, so the packed covariance is symmetric by construction
+        if self.packed:
+            self.P = self.P[self._packed_index]
+        else:
+            self.P = (self.P + self.P.T) / 2
+
+
+class ExtendedKalmanFilterBank:
+    def __init__(self, x0, P0_value, dt, g, count=None):
+        x0 = np.asarray(x0, dtype=float)
+
+        if x0.ndim == 1:
+            if count is None:
+                raise ValueError("count is required when x0 is shared by all filters")
+
+            x0 = np.broadcast_to(x0, (count, len(x0)))
+
+        self.x = np.array(x0, dtype=float)
+        self.count, self.n = self.x.shape
+
+        P0_value = np.asarray(P0_value, dtype=float)
+
+        if P0_value.ndim == 3:
+            self.P = np.array(np.broadcast_to(P0_value, (self.count, self.n, self.n)))
+        else:
+            self.P = np.eye(self.n)[None, :, :] * np.broadcast_to(P0_value, (self.count,))[:, None, None]
+
+        self.dt = dt
+        self.g = g
+
+        self._batch_handles = {}
+
+    def predict(self, u, f, F, Q, ctrl_vars):
+        u = self._per_filter_args(u)
+        ctrl_vars = self._per_filter_args(ctrl_vars)
+
+        calc_f = self._call(f, (*self.x.T, *u, self.g, self.dt), (self.n, 1))
+        calc_F = self._call(F, (*self.x.T, *u, self.g, self.dt), (self.n, self.n))
+        calc_Q = self._call(Q, (*self.x.T, *u, *ctrl_vars, self.g, self.dt), (self.n, self.n))
+
+        self.x = calc_f[:, :, 0]
+        self.P = calc_F @ self.P @ calc_F.transpose(0, 2, 1) + calc_Q
+
+        self._force_cov_symmetry()
+
+    def correct(self, z, h, H, R, meas_vars, mask=None):
+        z = np.asarray(z, dtype=float)
+        z = np.broadcast_to(z, (self.count, z.shape[-1]))
+        m = z.shape[1]
+
+        meas_vars = self._per_filter_args(meas_vars)
+
+        calc_h = self._call(h, tuple(self.x.T), (m, 1))[:, :, 0]
+        calc_H = self._call(H, tuple(self.x.T), (m, self.n))
+        calc_R = self._call(R, meas_vars, (m, m))
+
+        y = z - calc_h
+
+        if mask is not None:
+            # Masked measurements get a zero H row and a decoupled unit R entry, so their K column is zero
+            mask = np.broadcast_to(np.asarray(mask, dtype=bool), (self.count, m))
+            keep = mask[:, :, None] & mask[:, None, :]
+
+            y = np.where(mask, y, 0.0)
+            calc_H = np.where(mask[:, :, None], calc_H, 0.0)
+            calc_R = np.where(keep, calc_R, 0.0) + np.where(mask, 0.0, 1.0)[:, :, None] * np.eye(m)
+
+        PH_ = self.P @ calc_H.transpose(0, 2, 1)
+        S = calc_H @ PH_ + calc_R
+        K = np.linalg.solve(S, PH_.transpose(0, 2, 1)).transpose(0, 2, 1)
+
+        self.x = self.x + (K @ y[:, :, None])[:, :, 0]
+        I_KH = np.eye(self.n) - K @ calc_H
+        self.P = I_KH @ self.P @ I_KH.transpose(0, 2, 1) + K @ calc_R @ K.transpose(0, 2, 1)
+
+        self._force_cov_symmetry()
+
+    def _per_filter_args(self, values):
+        return [v if np.ndim(v) == 0 else np.asarray(v, dtype=float) for v in values]
+
+    def _call(self, func, args, shape):
+        if func not in self._batch_handles:
+            self._batch_handles[func] = _batch_handle(func)
+
+        out = np.asarray(self._batch_handles[func](*args), dtype=float)
+
+        if out.shape[-2:] != shape:
+            out = out.reshape(out.shape[:-2] + shape)
+
+        return np.broadcast_to(out, (self.count, *shape))
+
+    def _force_cov_symmetry(self):
+        self.P = (self.P + self.P.transpose(0, 2, 1)) / 2
+
+
+def _batch_array(rows):
+    entries = np.broadcast_arrays(*[np.asarray(v, dtype=float) for row in rows for v in row])
+    out = np.stack(entries, axis=-1)
+
+    return out.reshape(out.shape[:-1] + (len(rows), len(rows[0])))
+
+
+def _batch_handle(func):
+    # Lambdified matrices build their result with numpy's `array`, which cannot mix per-filter
+    # arrays and constant entries, so rebind it to a builder that broadcasts every entry first
+    if not isinstance(func, types.FunctionType) or "array" not in func.__globals__:
+        return func
+
+    namespace = dict(func.__globals__)
+    namespace["array"] = _batch_array
+
+    return types.FunctionType(func.__code__, namespace, func.__name__, func.__defaults__, func.__closure__)
+
+
+def _matrix_evaluator(func):
+    blocks = getattr(func, "blocks", None)
+
+    if blocks is not None:
+        # Entries that do not depend on the state are cached as one base matrix, only the state block is
+        # evaluated per call and written over a copy of it
+        shape = func.shape
+        fixed = [(np.ravel_multi_index((rows, cols), shape), block) for kind, _, rows, cols, block in blocks if kind != "state"]
+        state = [(np.ravel_multi_index((rows, cols), shape), block) for kind, _, rows, cols, block in blocks if kind == "state"]
+
+        def base(*args):
+            out = np.empty(shape)
+
+            for index, block in fixed:
+                out.flat[index] = np.ravel(block(*args))
+
+            return out
+
+        base.kind = "dt" if any(kind == "dt" for kind, *_ in blocks) else "constant"
+        base.depends = tuple(sorted({i for kind, depends, *_ in blocks if kind != "state" for i in depends}))
+        base = _matrix_evaluator(base)
+
+        def evaluate(args):
+            out = base(args).copy()
+
+            for index, block in state:
+                out.flat[index] = np.ravel(block(*args))
+
+            return out
+
+        return evaluate
+
+    if getattr(func, "kind", "state") == "state":
+        return lambda args: func(*args)
+
+    depends = func.depends
+    cache = {}
+
+    def evaluate(args):
+        key = tuple([args[i] for i in depends])
+
+        if key not in cache:
+            if len(cache) >= MATRIX_CACHE_SIZE:
+                del cache[next(iter(cache))]
+
+            # Read-only, so an in-place update of a filter matrix cannot corrupt the cache
+            cache[key] = np.array(func(*args), dtype=float)
+            cache[key].setflags(write=False)
+
+        return cache[key]
+
+    return evaluate
+
+
+# ================== STEADY STATE ==================
+
+
+# REF: https://en.wikipedia.org/wiki/Algebraic_Riccati_equation
+# REF: https://doi.org/10.1016/j.laa.2004.07.026 (structure-preserving doubling)
+def solve_dare(F, Q, H, R, tol=1e-13, max_iter=64):
+    # Steady prior covariance P = F (P - P H^T (H P H^T + R)^-1 H P) F^T + Q, the dual of the control DARE with A = F^T, B = H^T.
+    # Every doubling step covers twice as many Riccati iterations, so slow filters converge in a few dozen steps
+    I = np.eye(len(F))
+    A = np.array(F, dtype=float).T
+    G = H.T @ np.linalg.solve(R, H)
+    X = np.array(Q, dtype=float)
+
+    for _ in range(max_iter):
+        W = np.linalg.inv(I + G @ X)
+        X_next = X + A.T @ X @ W @ A
+        G = G + A @ W @ G @ A.T
+        A = A @ W @ A
+
+        if np.max(np.abs(X_next - X)) <= tol * max(np.max(np.abs(X_next)), 1.0):
+            return (X_next + X_next.T) / 2
+
+        X = X_next
+
+    raise ValueError("Riccati equation did not converge, the model is not detectable or not stabilizable")
+
+
+def steady_state_gain(F, Q, H, R):
+    P = solve_dare(F, Q, H, R)
+    K = np.linalg.solve(H @ P @ H.T + R, H @ P).T
+
+    return K, P
+
+
+class SteadyStateKalmanFilter:
+    # Fixed gain filter for linear time-invariant models, the covariance has converged so a step is only a state update.
+    # A gain assumes its measurements are fused every step, each measurement subset gets its own gain
+    def __init__(self, x0, dt, g, F, Q, H, R):
+        self.x = np.array([x0], dtype=float).T
+        self.dt = dt
+        self.g = g
+
+        self.F = np.asarray(F, dtype=float)
+        self.Q = np.asarray(Q, dtype=float)
+        self.H = np.asarray(H, dtype=float)
+        self.R = np.asarray(R, dtype=float)
+
+        self._gains = {}
+
+        gain = self._gain(None)
+
+        self.K = gain["K"]
+        self.P = (np.eye(len(self.x)) - gain["K"] @ self.H) @ gain["P"]
+
+    def gain(self, rows=None):
+        return self._gain(rows)["K"]
+
+    def predict(self, u, f):
+        self.x = f(*self.x[:, 0], *u, self.g, self.dt)
+
+    def correct(self, z, rows=None):
+        gain = self._gain(rows)
+
+        self.x = self.x + gain["K"] @ (np.array([z]).T - gain["H"] @ self.x)
+
+    def _gain(self, rows):
+        key = None if rows is None else tuple(rows)
+
+        if key not in self._gains:
+            rows = list(range(len(self.H))) if rows is None else list(rows)
+            H = self.H[rows, :]
+            K, P_prior = steady_state_gain(self.F, self.Q, H, self.R[np.ix_(rows, rows)])
+
+            self._gains[key] = {"K": K, "P": P_prior, "H": H}
+
+        return self._gains[key]
@@ -0,0 +1,134 @@
+import os
+import numpy as np
+from geo import geo
+
+SCHEMA_VERSION = 1
+GRAVITY = 9.80665
+
+# Sensor axes remapped into the board frame: (field, source column, sign, offset)
+SENSOR_COLUMNS = [
+    ("acc1_x", 1, 1, 0),
+    ("acc1_y", 2, 1, 0),
+    ("acc1_z", 3, 1, 0),
+    ("acc2_x", 5, 1, 0),
+    ("acc2_y", 4, -1, 0),
+    ("acc2_z", 6, 1, 0),
+    ("acc3_x", 8, -1, 0),
+    ("acc3_y", 7, 1, 0),
+    ("acc3_z", 9, 1, GRAVITY),
+    ("gyro1_x", 10, 1, 0),
+    ("gyro1_y", 11, 1, 0),
+    ("gyro1_z", 12, 1, 0),
+    ("gyro2_x", 14, 1, 0),
+    ("gyro2_y", 13, -1, 0),
+    ("gyro2_z", 15, 1, 0),
+    ("mag_x", 16, 1, 0),
+    ("mag_y", 17, 1, 0),
+    ("mag_z", 18, 1, 0),
+    ("press", 19, 1, 0),
+]
+
+# Older logs have no extra column after the temperature, so GPS starts one column earlier
+GPS_START_COLUMN = {
+    34: 21,
+    35: 22,
+}
+
+DTYPE = np.dtype(
+    [("timestamp", np.int64)]
+    + [(name, np.float64) for name, _, _, _ in SENSOR_COLUMNS]
+    + [("lat", np.float64), ("lon", np.float64), ("alt", np.float64), ("state", np.int8)]
+)
+
+
+def _sidecar_path(path):
+    return f"{os.path.splitext(path)[0]}.v{SCHEMA_VERSION}.npy"
+
+
+def _field_count(path):
+    with open(path) as file:
+        return len(file.readline().rstrip("\r\n").split(","))
+
+
+def parse_flight_log(path):
+    field_count = _field_count(path)
+
+    if field_count not in GPS_START_COLUMN:
+        raise ValueError(f"Unknown flight log layout with {field_count} fields: {path}")
+
+    gps = GPS_START_COLUMN[field_count]
+    raw = np.loadtxt(path, delimiter=",", usecols=range(gps + 4), ndmin=2)
+
+    return _from_raw(raw, gps)
+
+
+def parse_record(line):
+    # One live telemetry line in the same layout as the logs
+    fields = line.strip().split(",")
+
+    if len(fields) not in GPS_START_COLUMN:
+        raise ValueError(f"Unknown record layout with {len(fields)} fields")
+
+    gps = GPS_START_COLUMN[len(fields)]
+
+    return _from_raw(np.array([fields[: gps + 4]], dtype=float), gps)[0]
+
+
+def _from_raw(raw, gps):
+    log = np.empty(len(raw), dtype=DTYPE)
+    log["timestamp"] = raw[:, 0]
+
+    for name, column, sign, offset in SENSOR_COLUMNS:
+        log[name] = sign * raw[:, column] + offset
+
+    log["lat"] = raw[:, gps]
+    log["lon"] = raw[:, gps + 1]
+    log["alt"] = raw[:, gps + 2]
+    log["state"] = raw[:, gps + 3]
+
+    return log
+
+
+def load_flight_log(path, cache=True):
+    sidecar = _sidecar_path(path)
+
+    if cache and os.path.exists(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(path):
+        return np.load(sidecar, mmap_mode="r")
+
+    log = parse_flight_log(path)
+
+    if cache:
+        tmp_path = f"{sidecar}.{os.getpid()}.tmp.npy"
+
+        np.save(tmp_path, log)
+        os.replace(tmp_path, sidecar)
+
+    return log
+
+
+def fresh_mask(values):
+    # Logs repeat the last sample between sensor updates, a sample is fresh when any of its values changed
+    values = np.asarray(values)
+    values = values.reshape(len(values), -1)
+
+    fresh = np.empty(len(values), dtype=bool)
+    fresh[0] = True
+    fresh[1:] = np.any(values[1:] != values[:-1], axis=1)
+
+    return fresh
+
+
+def altitude_measurements(log):
+    frame = geo.LocalFrame(log["lat"][0], log["lon"][0], log["alt"][0])
+
+    # Launch site as seen from each fix, so the down component grows with height like the baro reading
+    pos = [-x for x in frame.geo_to_ned(log["lat"], log["lon"], log["alt"])]
+
+    return {
+        "t": (log["timestamp"] - log["timestamp"][0]) * 1e-6,
+        "pos": pos,
+        "gps_height": pos[2],
+        "baro_height": geo.baro_formula(log["press"]) - geo.baro_formula(log["press"][0]),
+        "gps_fresh": fresh_mask(np.column_stack([log["lat"], log["lon"], log["alt"]])),
+        "baro_fresh": fresh_mask(log["press"]),
+    }
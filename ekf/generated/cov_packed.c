@@ -0,0 +1,5 @@
+
+
+P_Next = P[0] + sigma_h;
+
+
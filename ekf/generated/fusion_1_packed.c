@@ -0,0 +1,10 @@
+
+
+H_Fusion = 1;
+
+
+
+
+K_Fusion = P[0]/(P[0] + R_BARO);
+
+
@@ -0,0 +1,23 @@
+// Fixed-gain filter, x_Correct uses the state after x_Predict
+x_Predict = z;
+
+
+K_Steady[0] = 0.255528388F;
+K_Steady[1] = 0.45427269F;
+
+
+x_Correct = 0.255528388F*meas[0] + 0.45427269F*meas[1] + 0.290198921F*z;
+
+
+K_Steady_0 = 0.537591907F;
+
+
+x_Correct_0 = 0.537591907F*meas[0] + 0.462408093F*z;
+
+
+K_Steady_1 = 0.635978366F;
+
+
+x_Correct_1 = 0.635978366F*meas[0] + 0.364021634F*z;
+
+
@@ -0,0 +1,88 @@
+"""
+Derived models are cached as generated Python modules keyed by a hash of their expressions.
+An index maps the hash of the model definition source to that key, so a warm start loads
+the numeric functions without importing SymPy.
+"""
+
+import hashlib
+import importlib.util
+import json
+import os
+
+CACHE_VERSION = 3
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "generated", "models")
+INDEX_FILE = "index.json"
+
+
+def _definition_hash():
+    path = os.path.dirname(os.path.abspath(__file__))
+    digest = hashlib.sha256(str(CACHE_VERSION).encode())
+
+    for name in ["derivation.py", "code_gen.py"]:
+        with open(os.path.join(path, name), "rb") as file:
+            digest.update(file.read())
+
+    return digest.hexdigest()
+
+
+def _model_path(cache_dir, model_hash):
+    return os.path.join(cache_dir, f"model_v{CACHE_VERSION}_{model_hash[:32]}.py")
+
+
+def _read_index(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, INDEX_FILE)) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_index(cache_dir, index):
+    tmp_path = os.path.join(cache_dir, f"{INDEX_FILE}.{os.getpid()}.tmp")
+
+    with open(tmp_path, "w") as file:
+        json.dump(index, file, indent=4)
+
+    os.replace(tmp_path, os.path.join(cache_dir, INDEX_FILE))
+
+
+def _load_handles(path):
+    spec = importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(path))[0], path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return {name: getattr(module, name) for name in module.FUNCTIONS}
+
+
+def load_model(cache_dir=CACHE_DIR):
+    source_hash = _definition_hash()
+    index = _read_index(cache_dir)
+
+    if source_hash in index and os.path.exists(_model_path(cache_dir, index[source_hash])):
+        return _load_handles(_model_path(cache_dir, index[source_hash]))
+
+    from . import code_gen, derivation
+
+    print("Model cache miss, deriving...")
+
+    model = derivation.define_model()
+    model_hash = derivation.model_hash(model)
+    path = _model_path(cache_dir, model_hash)
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+
+    # Always rewritten on a miss, the generators may have changed even if the expressions did not
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+
+    code_gen.write_py_model(tmp_path, model["functions"], derivation.generate_step_kernels(model), model_hash, derivation.classify_dependencies(model))
+    os.replace(tmp_path, path)
+
+    index[source_hash] = model_hash
+    _write_index(cache_dir, index)
+
+    return _load_handles(path)
+
+
+if __name__ == "__main__":
+    print(load_model())
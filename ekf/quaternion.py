@@ -1,46 +1,178 @@
+import math
+import numpy as np
+
+# Quaternions are [q0, q1, q2, q3] with q0 the scalar part, every function broadcasts over leading axes,
+# so a single (4,) quaternion and an (N, 4) history go through the same code.
+# A single quaternion or vector takes a Python float path instead and returns a list, NumPy costs
+# microseconds per call on 4 elements and per-sample callers run these every step
+
+
+def _single(*values):
+    singles = []
+
+    for x in values:
+        if type(x) is np.ndarray and x.ndim == 1:
+            singles.append(x.tolist())
+        elif type(x) in (list, tuple) and type(x[0]) not in (list, tuple, np.ndarray):
+            singles.append(x)
+        else:
+            return None
+
+    return singles
+
+
 def quat_normalize(q):
-    d = (q[0] ** 2 + q[1] ** 2 + q[2] ** 2 + q[3] ** 2) ** 0.5
+    single = _single(q)
 
-    return [
-        q[0] / d,
-        q[1] / d,
-        q[2] / d,
-        q[3] / d,
-    ]
+    if single is not None:
+        [q0, q1, q2, q3] = single[0]
+        d = math.sqrt(q0 * q0 + q1 * q1 + q2 * q2 + q3 * q3)
+
+        return [q0 / d, q1 / d, q2 / d, q3 / d]
+
+    q = np.asarray(q, dtype=float)
+
+    return q / np.linalg.norm(q, axis=-1, keepdims=True)
+
+
+def quat_conj(q):
+    single = _single(q)
+
+    if single is not None:
+        return [single[0][0], -single[0][1], -single[0][2], -single[0][3]]
+
+    q = np.asarray(q, dtype=float)
+
+    return q * np.array([1.0, -1.0, -1.0, -1.0])
+
+
+def quat_mult(p, q):
+    single = _single(p, q)
+
+    if single is not None:
+        [[p0, p1, p2, p3], [q0, q1, q2, q3]] = single
+
+        return [
+            p0 * q0 - p1 * q1 - p2 * q2 - p3 * q3,
+            p0 * q1 + p1 * q0 + p2 * q3 - p3 * q2,
+            p0 * q2 - p1 * q3 + p2 * q0 + p3 * q1,
+            p0 * q3 + p1 * q2 - p2 * q1 + p3 * q0,
+        ]
+
+    p = np.asarray(p, dtype=float)
+    q = np.asarray(q, dtype=float)
+
+    p0, p1, p2, p3 = p[..., 0], p[..., 1], p[..., 2], p[..., 3]
+    q0, q1, q2, q3 = q[..., 0], q[..., 1], q[..., 2], q[..., 3]
+
+    return np.stack(
+        [
+            p0 * q0 - p1 * q1 - p2 * q2 - p3 * q3,
+            p0 * q1 + p1 * q0 + p2 * q3 - p3 * q2,
+            p0 * q2 - p1 * q3 + p2 * q0 + p3 * q1,
+            p0 * q3 + p1 * q2 - p2 * q1 + p3 * q0,
+        ],
+        axis=-1,
+    )
 
 
 def quat_from_vecs(a, b):
-    cross = [
-        a[1] * b[2] - a[2] * b[1],
-        a[2] * b[0] - a[0] * b[2],
-        a[0] * b[1] - a[1] * b[0],
-    ]
-    dot = a[0] * b[0] + a[1] * b[1] + a[2] * b[2]
-    a_mag = (a[0] ** 2 + a[1] ** 2 + a[2] ** 2) ** 0.5
-    b_mag = (b[0] ** 2 + b[1] ** 2 + b[2] ** 2) ** 0.5
+    single = _single(a, b)
+
+    if single is not None:
+        [[ax, ay, az], [bx, by, bz]] = single
 
-    q = [0, 0, 0, 0]
+        dot = ax * bx + ay * by + az * bz
+        a_mag = math.sqrt(ax * ax + ay * ay + az * az)
+        b_mag = math.sqrt(bx * bx + by * by + bz * bz)
 
-    q[0] = a_mag * b_mag + dot
-    q[1] = cross[0]
-    q[2] = cross[1]
-    q[3] = cross[2]
+        return quat_normalize([a_mag * b_mag + dot, ay * bz - az * by, az * bx - ax * bz, ax * by - ay * bx])
+
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+
+    cross = np.cross(a, b)
+    dot = np.sum(a * b, axis=-1)
+    a_mag = np.linalg.norm(a, axis=-1)
+    b_mag = np.linalg.norm(b, axis=-1)
+
+    q = np.concatenate([(a_mag * b_mag + dot)[..., None], cross], axis=-1)
 
     return quat_normalize(q)
 
 
+# REF: https://en.wikipedia.org/wiki/Quaternions_and_spatial_rotation#Using_quaternions_as_rotations
 def quat_rotate_vec(q, v):
-    q0 = q[0]
-    q1 = q[1]
-    q2 = q[2]
-    q3 = q[3]
+    single = _single(q, v)
+
+    if single is not None:
+        [[q0, q1, q2, q3], [vx, vy, vz]] = single
+    else:
+        q = np.asarray(q, dtype=float)
+        v = np.asarray(v, dtype=float)
 
-    vx = v[0]
-    vy = v[1]
-    vz = v[2]
+        q0, q1, q2, q3 = q[..., 0], q[..., 1], q[..., 2], q[..., 3]
+        vx, vy, vz = v[..., 0], v[..., 1], v[..., 2]
 
-    return [
+    rotated = [
         +vx * (1 - 2 * (q2**2 + q3**2)) + vy * (2 * (q1 * q2 - q0 * q3)) + vz * (2 * (q1 * q3 + q0 * q2)),
         +vx * (2 * (q1 * q2 + q0 * q3)) + vy * (1 - 2 * (q1**2 + q3**2)) + vz * (2 * (q2 * q3 - q0 * q1)),
         +vx * (2 * (q1 * q3 - q0 * q2)) + vy * (2 * (q2 * q3 + q0 * q1)) + vz * (1 - 2 * (q1**2 + q2**2)),
     ]
+
+    return rotated if single is not None else np.stack(rotated, axis=-1)
+
+
+# REF: https://en.wikipedia.org/wiki/Axis%E2%80%93angle_representation#Exponential_map_from_so(3)_to_SO(3)
+def quat_from_rotvec(theta):
+    single = _single(theta)
+
+    if single is not None:
+        [tx, ty, tz] = single[0]
+        angle = math.sqrt(tx * tx + ty * ty + tz * tz)
+        scale = 0.5 - angle**2 / 48 if angle < 1e-6 else math.sin(angle / 2) / angle
+
+        return [math.cos(angle / 2), tx * scale, ty * scale, tz * scale]
+
+    theta = np.asarray(theta, dtype=float)
+    angle = np.linalg.norm(theta, axis=-1)
+
+    # sin(x / 2) / x tends to 1 / 2, the series keeps small angles exact
+    small = angle < 1e-6
+    scale = np.where(small, 0.5 - angle**2 / 48, np.sin(angle / 2) / np.where(small, 1, angle))
+
+    return np.concatenate([np.cos(angle / 2)[..., None], theta * scale[..., None]], axis=-1)
+
+
+def quat_cumprod(q):
+    # Hillis-Steele prefix scan, the product is associative so log2(N) vectorized passes replace the sample loop
+    q = np.array(q, dtype=float)
+    shift = 1
+
+    while shift < len(q):
+        q[shift:] = quat_mult(q[:-shift], q[shift:])
+        shift *= 2
+
+    return q
+
+
+# ================== STRAPDOWN ==================
+
+
+def integrate_gyro(q0, gyro, dt):
+    # Body rates (N, 3) in rad/s to the attitude after each sample, the increments are applied in the body frame
+    gyro = np.asarray(gyro, dtype=float)
+    dt = np.asarray(dt, dtype=float)
+
+    dq = quat_from_rotvec(gyro * (dt[..., None] if dt.ndim else dt))
+    dq[0] = quat_mult(q0, dq[0])
+
+    return quat_normalize(quat_cumprod(dq))
+
+
+def accel_to_ned(q, acc, g=0.0):
+    # Body frame specific force (N, 3) rotated by the attitude history, g is added to the down axis
+    ned = np.asarray(quat_rotate_vec(q, acc), dtype=float)
+    ned[..., 2] += g
+
+    return ned
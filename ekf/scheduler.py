@@ -0,0 +1,112 @@
+"""
+Resources:
+    - https://github.com/PX4/PX4-ECL/blob/master/EKF/ekf.cpp
+    - https://docs.px4.io/main/en/advanced_config/tuning_the_ecl_ekf.html#sensor-delays
+"""
+
+from collections import deque
+import numpy as np
+
+
+def _keep_dependencies(selected, func):
+    # A row selection depends on the same arguments, so the filter can still cache it
+    if hasattr(func, "kind"):
+        selected.kind = "state" if hasattr(func, "blocks") else func.kind
+        selected.depends = func.depends
+
+    return selected
+
+
+def select_measurements(h, H, R, rows):
+    rows = list(rows)
+
+    return (
+        lambda *x: h(*x)[rows, :],
+        _keep_dependencies(lambda *x: H(*x)[rows, :], H),
+        _keep_dependencies(lambda *v: R(*v)[np.ix_(rows, rows)], R),
+    )
+
+
+class SensorScheduler:
+    # The filter runs on a delayed fusion horizon: inputs are buffered and only predicted once they are older
+    # than the largest sensor delay, so every measurement is fused at the time it was actually sampled.
+    # filt.x lags the newest input by that delay, on_step(time, filt) sees each state with its own timestamp
+    def __init__(self, filt, predict, buffer_size=400, on_step=None):
+        self.filt = filt
+        self.predict = predict
+        self.buffer_size = buffer_size
+        self.on_step = on_step
+        self.delay = 0.0
+        self.time = None
+
+        self._inputs = deque()
+        self._sensors = {}
+
+    def add_sensor(self, name, correct, delay=0.0):
+        self._sensors[name] = {
+            "correct": correct,
+            "delay": delay,
+            "queue": deque(),
+            "last_time": None,
+            "fused": 0,
+            "stale": 0,
+            "late": 0,
+        }
+
+        self.delay = max(self.delay, delay)
+
+    def push_input(self, timestamp, u):
+        if len(self._inputs) == self.buffer_size:
+            self._step()
+
+        self._inputs.append((timestamp, u))
+        self._advance(timestamp - self.delay)
+
+    def push_measurement(self, name, timestamp, z):
+        sensor = self._sensors[name]
+
+        if sensor["last_time"] is not None and timestamp <= sensor["last_time"]:
+            sensor["stale"] += 1
+            return
+
+        sensor["last_time"] = timestamp
+        sample_time = timestamp - sensor["delay"]
+
+        if self.time is not None and sample_time < self.time:
+            sensor["late"] += 1
+            return
+
+        if len(sensor["queue"]) == self.buffer_size:
+            sensor["queue"].popleft()
+            sensor["late"] += 1
+
+        sensor["queue"].append((sample_time, z))
+
+    def flush(self):
+        while self._inputs:
+            self._step()
+
+    def stats(self):
+        return {name: {k: sensor[k] for k in ["fused", "stale", "late"]} for name, sensor in self._sensors.items()}
+
+    def _advance(self, horizon):
+        while self._inputs and self._inputs[0][0] <= horizon:
+            self._step()
+
+    def _step(self):
+        timestamp, u = self._inputs.popleft()
+
+        self.predict(self.filt, u)
+        self.time = timestamp
+
+        for sensor in self._sensors.values():
+            queue = sensor["queue"]
+
+            while queue and queue[0][0] <= timestamp:
+                _, z = queue.popleft()
+
+                sensor["correct"](self.filt, z)
+                sensor["fused"] += 1
+
+        if self.on_step is not None:
+            self.on_step(self.time, self.filt)
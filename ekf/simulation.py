@@ -1,8 +1,9 @@
-import csv
+import argparse
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-import matplotlib.pyplot as plt
-from geo import geo
-from . import ekf, derivation, voting, quaternion
+from . import ekf, flightlog, model_cache, scheduler
 
 # ========== CONSTANTS ==========
 
@@ -10,115 +11,170 @@ from . import ekf, derivation, voting, quaternion
 g = -9.80665
 dt = 0.0025
 
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
 
-# ========== DATA ==========
-
-
-data = []
-
-with open("./ekf/data/flightlog3.csv") as file:
-    reader = csv.reader(file, delimiter=",")
-
-    base_params = []
-
-    for x in reader:
-        acc1_x = float(x[1])
-        acc1_y = float(x[2])
-        acc1_z = float(x[3])
-        acc2_x = float(x[5])
-        acc2_y = -float(x[4])
-        acc2_z = float(x[6])
-        acc3_x = -float(x[8])
-        acc3_y = float(x[7])
-        acc3_z = float(x[9]) - g
-        gyro1_x = float(x[10])
-        gyro1_y = float(x[11])
-        gyro1_z = float(x[12])
-        gyro2_x = float(x[14])
-        gyro2_y = -float(x[13])
-        gyro2_z = float(x[12])
-        mag_x = float(x[16])
-        mag_y = float(x[17])
-        mag_z = float(x[18])
-        press = float(x[19])
-        lat = float(x[22])
-        lon = float(x[23])
-        alt = float(x[24])
-        state = float(x[25])
-
-        if len(base_params) == 0:
-            base_params = [geo.baro_formula(press), lat, lon, alt]
-
-        currentHeight = geo.baro_formula(press) - base_params[0]
-
-        pos = geo.geo_to_ned(lat, lon, alt, base_params[1], base_params[2], base_params[3])
-
-        data.append(
-            [
-                pos[0],
-                pos[1],
-                pos[2],
-                currentHeight,
-                mag_x,
-                mag_y,
-                mag_z,
-                acc1_x,
-                acc1_y,
-                acc1_z,
-                acc2_x,
-                acc2_y,
-                acc2_z,
-                acc3_x,
-                acc3_y,
-                acc3_z,
-                gyro1_x,
-                gyro1_y,
-                gyro1_z,
-                gyro2_x,
-                gyro2_y,
-                gyro2_z,
-                state,
-            ]
-        )
+DEFAULT_PARAMS = {
+    "start_covariance_value": 1,
+    "variance_gps": 1.6,
+    "variance_baro_height": 0.9,
+    "sigma_h": 1.0,
+    "delay_gps": 0.0,
+    "delay_baro": 0.0,
+}
+
+_worker = {}
 
 
 # ========== FILTER ==========
 
 
-start_state = [0]
-start_covariance_value = 1
-variance_gps = 1.6
-variance_baro_height = 0.9
+def run_filter(handles, meas, params=DEFAULT_PARAMS):
+    params = {**DEFAULT_PARAMS, **params}
+
+    filt = ekf.ExtendedKalmanFilter([0], params["start_covariance_value"], dt, g)
+    meas_vars = [params["variance_gps"], params["variance_baro_height"]]
+    innovations = {"gps": [], "baro": []}
+
+    def fuse(name, row):
+        kernel = handles[f"correct_{row}"]
+
+        def correct(filt, z):
+            # One fused call, the innovation comes out of the same evaluation as the update
+            y, S = filt.correct_step(z, kernel, meas_vars)
+
+            innovations[name].append((sched.time, y[0, 0], S[0, 0]))
+
+        return correct
+
+    t = meas["t"]
+    history = {"t": np.empty(len(t)), "x": np.empty((len(t), len(filt.x))), "P_diag": np.empty((len(t), len(filt.x)))}
+    steps = [0]
+
+    def record(time, filt):
+        # States are stored at the fusion horizon time they belong to, not at the newest input
+        history["t"][steps[0]] = time
+        history["x"][steps[0]] = filt.x[:, 0]
+        history["P_diag"][steps[0]] = np.diagonal(filt.P)
+        steps[0] += 1
+
+    sched = scheduler.SensorScheduler(filt, lambda filt, u: filt.predict_step(u, handles["predict"], [params["sigma_h"]]), on_step=record)
+    sched.add_sensor("gps", fuse("gps", 0), params["delay_gps"])
+    sched.add_sensor("baro", fuse("baro", 1), params["delay_baro"])
+
+    for i in range(len(t)):
+        if meas["gps_fresh"][i]:
+            sched.push_measurement("gps", t[i], [meas["gps_height"][i]])
+
+        if meas["baro_fresh"][i]:
+            sched.push_measurement("baro", t[i], [meas["baro_height"][i]])
+
+        sched.push_input(t[i], [])
+
+    # The last inputs are still inside the delay window
+    sched.flush()
+
+    return {
+        "t": history["t"],
+        "x": history["x"],
+        "P_diag": history["P_diag"],
+        "innovations_gps": np.array(innovations["gps"]).reshape(-1, 3),
+        "innovations_baro": np.array(innovations["baro"]).reshape(-1, 3),
+        "stats": sched.stats(),
+    }
+
+
+# ========== BATCH ==========
+
+
+def _init_worker(cache_dir):
+    _worker["handles"] = model_cache.load_model(cache_dir)
 
-handles = derivation.run_derivation(False)
-filt = ekf.ExtendedKalmanFilter(
-    start_state,
-    start_covariance_value,
-    dt,
-    g,
-)
 
-filter_data = []
+def output_path(output_dir, log_path):
+    return os.path.join(output_dir, os.path.splitext(os.path.basename(log_path))[0] + ".npz")
 
-for i in range(len(data)):
-    filt.predict([], handles["f"], handles["F"], handles["Q"], [1])
-    filt.correct([data[i][2], data[i][3]], handles["h"], handles["H"], handles["R"], [variance_gps, variance_baro_height])
 
-    filter_data.append(filt.x[:, 0])
+def _replay(task):
+    log_path, output_dir, params = task
+
+    meas = flightlog.altitude_measurements(flightlog.load_flight_log(log_path))
+    result = run_filter(_worker["handles"], meas, params)
+    path = output_path(output_dir, log_path)
+
+    # Histories are stored as float32, the time base and innovations keep full precision
+    np.savez_compressed(
+        path,
+        t=result["t"],
+        x=result["x"].astype(np.float32),
+        P_diag=result["P_diag"].astype(np.float32),
+        gps_height=np.asarray(meas["gps_height"], dtype=np.float32),
+        baro_height=np.asarray(meas["baro_height"], dtype=np.float32),
+        innovations_gps=result["innovations_gps"],
+        innovations_baro=result["innovations_baro"],
+    )
+
+    return log_path, path, result["stats"]
+
+
+def replay_logs(log_paths, output_dir, params=DEFAULT_PARAMS, processes=None, cache_dir=model_cache.CACHE_DIR):
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+
+    # The cache is filled once here, so workers never derive the model concurrently
+    model_cache.load_model(cache_dir)
+
+    tasks = [(path, output_dir, params) for path in log_paths]
+
+    if processes == 1 or len(tasks) == 1:
+        _init_worker(cache_dir)
+
+        return [_replay(task) for task in tasks]
+
+    with ProcessPoolExecutor(processes, initializer=_init_worker, initargs=(cache_dir,)) as pool:
+        return list(pool.map(_replay, tasks))
 
 
 # ========== ANALYSIS ==========
 
 
-figure, axis = plt.subplots(1, 3)
+def plot(result_paths):
+    import matplotlib.pyplot as plt
+
+    for path in result_paths:
+        with np.load(path) as data:
+            figure, axis = plt.subplots(1, 3)
+
+            figure.set_figwidth(30)
+            figure.set_figheight(10)
+            figure.suptitle(os.path.basename(path))
+
+            axis[0].plot(data["t"], data["x"][:, 0])
+            axis[1].plot(data["t"], data["baro_height"])
+            axis[2].plot(data["t"], data["gps_height"])
+
+    plt.show()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("logs", nargs="*", help="flight logs, all logs in ekf/data by default")
+    parser.add_argument("--output-dir", default="./simulation_results")
+    parser.add_argument("--processes", type=int)
+    parser.add_argument("--model-cache", default=model_cache.CACHE_DIR)
+    parser.add_argument("--plot", action="store_true")
+
+    for name, value in DEFAULT_PARAMS.items():
+        parser.add_argument("--" + name.replace("_", "-"), type=float, default=value)
+
+    args = parser.parse_args()
 
-figure.set_figwidth(30)
-figure.set_figheight(10)
+    log_paths = args.logs or sorted(glob.glob(os.path.join(DATA_DIR, "*.csv")))
+    params = {name: getattr(args, name) for name in DEFAULT_PARAMS}
 
-t = np.arange(0, len(filter_data) * dt, dt)
+    results = replay_logs(log_paths, args.output_dir, params, args.processes, args.model_cache)
 
-axis[0].plot(t, list(map(lambda x: x[0], filter_data)))
-axis[1].plot(t, list(map(lambda x: x[3], data)))
-axis[2].plot(t, list(map(lambda x: x[2], data)))
+    for log_path, path, stats in results:
+        print(f"{log_path} -> {path} {stats}")
 
-plt.show()
+    if args.plot:
+        plot([path for _, path, _ in results])
@@ -0,0 +1,145 @@
+"""
+Resources:
+    - https://en.wikipedia.org/wiki/Kalman_filter#Rauch%E2%80%93Tung%E2%80%93Striebel
+"""
+
+import numpy as np
+from . import ekf
+
+
+def _allocate_buffers(size, n):
+    return {
+        "F": np.empty((size, n, n)),
+        "x_prior": np.empty((size, n)),
+        "P_prior": np.empty((size, n, n)),
+        "x_post": np.empty((size, n)),
+        "P_post": np.empty((size, n, n)),
+    }
+
+
+def _run_forward(filt, start, stop, buffers, f, F, Q, ctrl_vars, correct, inputs):
+    for k in range(start, stop):
+        i = k - start
+        u = inputs(k)
+
+        buffers["F"][i] = F(*filt.x[:, 0], *u, filt.g, filt.dt)
+        filt.predict(u, f, F, Q, ctrl_vars)
+        buffers["x_prior"][i] = filt.x[:, 0]
+        buffers["P_prior"][i] = filt.P
+
+        correct(filt, k)
+        buffers["x_post"][i] = filt.x[:, 0]
+        buffers["P_post"][i] = filt.P
+
+
+def _run_backward(buffers, length, carry, x_out, P_diag_out):
+    # Step k is smoothed from step k + 1, the last step of a chunk uses the first step of the following chunk
+    if carry is None:
+        # Copies, the buffers are overwritten by the forward re-run of the previous chunk while these are carried
+        x_next, P_next = buffers["x_post"][length - 1].copy(), buffers["P_post"][length - 1].copy()
+        count = length - 1
+        F_n = buffers["F"][1:length]
+        x_prior_n = buffers["x_prior"][1:length]
+        P_prior_n = buffers["P_prior"][1:length]
+    else:
+        F_c, x_prior_c, P_prior_c, x_next, P_next = carry
+        count = length
+        F_n = np.concatenate([buffers["F"][1:length], F_c[None]])
+        x_prior_n = np.concatenate([buffers["x_prior"][1:length], x_prior_c[None]])
+        P_prior_n = np.concatenate([buffers["P_prior"][1:length], P_prior_c[None]])
+
+    P_post = buffers["P_post"][:count]
+
+    # All gains of the chunk in one batched solve: C_k = P_k F_k+1^T (P_k+1|k)^-1
+    C = np.linalg.solve(P_prior_n, F_n @ P_post).transpose(0, 2, 1)
+
+    if carry is None:
+        x_out[count] = x_next
+        P_diag_out[count] = np.diagonal(P_next)
+
+    for k in range(count - 1, -1, -1):
+        x_next = buffers["x_post"][k] + C[k] @ (x_next - x_prior_n[k])
+        P_next = buffers["P_post"][k] + C[k] @ (P_next - P_prior_n[k]) @ C[k].T
+
+        x_out[k] = x_next
+        P_diag_out[k] = np.diagonal(P_next)
+
+    return x_next, P_next
+
+
+def rts_smooth(filt, count, f, F, Q, ctrl_vars, correct, inputs=lambda k: [], chunk_size=4096, out=None):
+    n = len(filt.x)
+    chunk_size = max(1, min(chunk_size, count))
+    chunks = (count + chunk_size - 1) // chunk_size
+
+    if out is None:
+        out = {
+            "x_filtered": np.empty((count, n)),
+            "x": np.empty((count, n)),
+            "P_diag": np.empty((count, n)),
+        }
+
+    buffers = _allocate_buffers(chunk_size, n)
+    checkpoints_x = np.empty((chunks, n))
+    checkpoints_P = np.empty((chunks, n, n))
+
+    # Forward pass only keeps a checkpoint per chunk, the buffers end up holding the last chunk
+    for c in range(chunks):
+        start = c * chunk_size
+        stop = min(start + chunk_size, count)
+
+        checkpoints_x[c] = filt.x[:, 0]
+        checkpoints_P[c] = filt.P
+
+        _run_forward(filt, start, stop, buffers, f, F, Q, ctrl_vars, correct, inputs)
+        out["x_filtered"][start:stop] = buffers["x_post"][: stop - start]
+
+    final_x, final_P = filt.x.copy(), filt.P.copy()
+    carry = None
+
+    for c in reversed(range(chunks)):
+        start = c * chunk_size
+        stop = min(start + chunk_size, count)
+
+        if c != chunks - 1:
+            filt.x = checkpoints_x[c][:, None].copy()
+            filt.P = checkpoints_P[c].copy()
+
+            _run_forward(filt, start, stop, buffers, f, F, Q, ctrl_vars, correct, inputs)
+
+        x_s, P_s = _run_backward(buffers, stop - start, carry, out["x"][start:stop], out["P_diag"][start:stop])
+        carry = (buffers["F"][0].copy(), buffers["x_prior"][0].copy(), buffers["P_prior"][0].copy(), x_s, P_s)
+
+    filt.x, filt.P = final_x, final_P
+
+    return out
+
+
+# ================== TEST CASES ==================
+
+
+if __name__ == "__main__":
+    # Constant velocity model with position fixes, every chunking has to match the unchunked smoother,
+    # including chunk sizes that leave a single step in the last chunk
+    count = 21
+    F_cv = np.array([[1.0, 0.1], [0.0, 1.0]])
+    z = np.sin(np.arange(count) * 0.3)
+
+    f = lambda p, v, g, dt: F_cv @ np.array([[p], [v]])
+    F = lambda p, v, g, dt: F_cv
+    Q = lambda p, v, g, dt: np.diag([0.01, 0.1])
+    h = lambda p, v: np.array([[p]])
+    H = lambda p, v: np.array([[1.0, 0.0]])
+    R = lambda: np.array([[0.5]])
+
+    def smooth(chunk_size):
+        filt = ekf.ExtendedKalmanFilter([0, 0], 1, 0.1, 0)
+
+        return rts_smooth(filt, count, f, F, Q, [], lambda filt, k: filt.correct([z[k]], h, H, R, []), chunk_size=chunk_size)
+
+    reference = smooth(count)
+
+    for chunk_size in [1, 2, 3, 4, 5, 7, 10, 20]:
+        result = smooth(chunk_size)
+
+        print(chunk_size, max(np.max(np.abs(result[name] - reference[name])) for name in ["x_filtered", "x", "P_diag"]))
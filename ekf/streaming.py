@@ -0,0 +1,322 @@
+"""
+Resources:
+    - https://docs.python.org/3/library/asyncio-queue.html
+    - https://docs.python.org/3/library/asyncio-protocol.html#datagram-protocols
+    - https://docs.python.org/3/library/asyncio-stream.html
+"""
+
+from collections import deque
+import argparse
+import asyncio
+import time
+import numpy as np
+from geo import geo
+from . import ekf, flightlog, model_cache, scheduler, simulation, voting
+
+QUEUE_SIZE = 64
+LATENCY_WINDOW = 4096
+# Seconds the demo waits for the last records after sending, datagrams lost in the kernel never arrive
+DEMO_TIMEOUT = 2.0
+
+# Full scale ranges and noise variances of the redundant sensors, per axis
+ACC_RANGES = [16 * flightlog.GRAVITY, 16 * flightlog.GRAVITY, 32 * flightlog.GRAVITY]
+ACC_VARIANCES = [0.01, 0.01, 0.05]
+GYRO_RANGES = [34.9, 34.9]
+GYRO_VARIANCES = [0.0001, 0.0001]
+
+
+# ================== METRICS ==================
+
+
+class LatencyStats:
+    def __init__(self, window=LATENCY_WINDOW):
+        self.count = 0
+        self.samples = deque(maxlen=window)
+
+    def add(self, seconds):
+        self.count += 1
+        self.samples.append(seconds)
+
+    def summary(self):
+        if not self.samples:
+            return {"count": self.count}
+
+        samples = np.array(self.samples) * 1e6
+
+        return {
+            "count": self.count,
+            "mean_us": float(np.mean(samples)),
+            "p99_us": float(np.percentile(samples, 99)),
+            "max_us": float(np.max(samples)),
+        }
+
+
+# ================== PIPELINE ==================
+
+
+class TelemetryPipeline:
+    # receive -> parse -> vote/convert -> filter, every hop is a bounded queue so a slow stage pushes back on
+    # the one before it; TCP then stops reading from the socket, UDP datagrams that find a full queue are dropped.
+    # on_state(sample, x, P) is called after every filter step, sample carries the voted "acc" and "gyro" per axis
+    def __init__(self, handles, params=simulation.DEFAULT_PARAMS, queue_size=QUEUE_SIZE, on_state=None):
+        params = {**simulation.DEFAULT_PARAMS, **params}
+
+        self.params = params
+        self.on_state = on_state
+        self.dropped = 0
+        self.errors = 0
+
+        self.raw = asyncio.Queue(queue_size)
+        self.records = asyncio.Queue(queue_size)
+        self.samples = asyncio.Queue(queue_size)
+
+        self.latency = {name: LatencyStats() for name in ["queue", "parse", "convert", "filter", "total"]}
+
+        self.acc_voting = voting.SensorVoting(ACC_RANGES, ACC_VARIANCES)
+        self.gyro_voting = voting.SensorVoting(GYRO_RANGES, GYRO_VARIANCES)
+
+        self.filt = ekf.ExtendedKalmanFilter([0], params["start_covariance_value"], simulation.dt, simulation.g)
+        self.meas_vars = [params["variance_gps"], params["variance_baro_height"]]
+
+        # Fused per-measurement kernels, as in simulation.run_filter
+        self.sched = scheduler.SensorScheduler(self.filt, lambda filt, u: filt.predict_step(u, handles["predict"], [params["sigma_h"]]))
+        self.sched.add_sensor("gps", lambda filt, z: filt.correct_step(z, handles["correct_0"], self.meas_vars), params["delay_gps"])
+        self.sched.add_sensor("baro", lambda filt, z: filt.correct_step(z, handles["correct_1"], self.meas_vars), params["delay_baro"])
+
+        self._frame = None
+        self._press0 = None
+        self._last = None
+        self._t0 = None
+
+    def feed(self, line, received=None):
+        # Non-blocking entry for datagram callbacks
+        try:
+            self.raw.put_nowait((line, received or time.perf_counter()))
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def put(self, line, received=None):
+        await self.raw.put((line, received or time.perf_counter()))
+
+    async def run(self):
+        # A failing stage cancels the others and re-raises, so a dead pipeline cannot keep reporting a frozen state
+        stages = [asyncio.create_task(stage) for stage in [self._parse_stage(), self._convert_stage(), self._filter_stage()]]
+
+        try:
+            await asyncio.gather(*stages)
+        finally:
+            for stage in stages:
+                stage.cancel()
+
+    def stats(self):
+        return {
+            "latency": {name: item.summary() for name, item in self.latency.items()},
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "sensors": self.sched.stats(),
+        }
+
+    async def _parse_stage(self):
+        while True:
+            line, received = await self.raw.get()
+            start = time.perf_counter()
+
+            self.latency["queue"].add(start - received)
+
+            try:
+                record = flightlog.parse_record(line)
+            except ValueError:
+                self.errors += 1
+                continue
+
+            self.latency["parse"].add(time.perf_counter() - start)
+
+            await self.records.put((record, received))
+
+    async def _convert_stage(self):
+        while True:
+            record, received = await self.records.get()
+            start = time.perf_counter()
+
+            sample = self._convert(record)
+
+            self.latency["convert"].add(time.perf_counter() - start)
+
+            await self.samples.put((sample, received))
+
+    async def _filter_stage(self):
+        while True:
+            sample, received = await self.samples.get()
+            start = time.perf_counter()
+
+            if sample["gps_fresh"]:
+                self.sched.push_measurement("gps", sample["t"], [sample["gps_height"]])
+
+            if sample["baro_fresh"]:
+                self.sched.push_measurement("baro", sample["t"], [sample["baro_height"]])
+
+            self.sched.push_input(sample["t"], [])
+
+            end = time.perf_counter()
+
+            self.latency["filter"].add(end - start)
+            self.latency["total"].add(end - received)
+
+            if self.on_state is not None:
+                self.on_state(sample, self.filt.x[:, 0], self.filt.P)
+
+    def _convert(self, record):
+        # Same conversions as flightlog.altitude_measurements, one record at a time
+        if self._frame is None:
+            self._frame = geo.LocalFrame(record["lat"], record["lon"], record["alt"])
+            self._press0 = geo.baro_formula(record["press"])
+            self._t0 = record["timestamp"]
+
+        fix = (record["lat"], record["lon"], record["alt"])
+        gps_fresh = self._last is None or fix != self._last[0]
+        baro_fresh = self._last is None or record["press"] != self._last[1]
+
+        self._last = (fix, record["press"])
+
+        sample = {
+            "t": (record["timestamp"] - self._t0) * 1e-6,
+            "gps_height": -self._frame.geo_to_ned(*fix)[2],
+            "baro_height": geo.baro_formula(record["press"]) - self._press0,
+            "gps_fresh": gps_fresh,
+            "baro_fresh": baro_fresh,
+        }
+
+        # The altitude model has no inputs, the voted IMU is only an output for on_state and is skipped without one
+        if self.on_state is not None:
+            sample["acc"] = [self.acc_voting.vote([record[f"acc{i}_{axis}"] for i in [1, 2, 3]])[0] for axis in "xyz"]
+            sample["gyro"] = [self.gyro_voting.vote([record[f"gyro{i}_{axis}"] for i in [1, 2]])[0] for axis in "xyz"]
+
+        return sample
+
+
+# ================== TRANSPORT ==================
+
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+
+    def datagram_received(self, data, addr):
+        received = time.perf_counter()
+
+        for line in data.decode().splitlines():
+            if line:
+                self.pipeline.feed(line, received)
+
+
+async def serve_udp(pipeline, host, port):
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(lambda: _DatagramProtocol(pipeline), local_addr=(host, port))
+
+    return transport
+
+
+async def serve_tcp(pipeline, host, port):
+    async def handle(reader, writer):
+        while line := await reader.readline():
+            await pipeline.put(line.decode())
+
+        writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+async def send_log(path, host, port, protocol="udp", rate=1 / simulation.dt, limit=None):
+    # Local stand-in for the downlink, replays a log line by line at the sample rate
+    with open(path) as file:
+        lines = [line.strip() for line in file if line.strip()][:limit]
+
+    loop = asyncio.get_running_loop()
+
+    if protocol == "udp":
+        transport, _ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol, remote_addr=(host, port))
+        send = lambda data: transport.sendto(data)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+        transport = writer
+        send = writer.write
+
+    start = loop.time()
+
+    for i, line in enumerate(lines):
+        # Absolute schedule so the sleep jitter does not add up
+        delay = start + i / rate - loop.time()
+
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        send((line + "\n").encode())
+
+        if protocol == "tcp":
+            await writer.drain()
+
+    transport.close()
+
+    return len(lines)
+
+
+async def _demo(path, protocol, host, port, rate, limit, timeout=DEMO_TIMEOUT):
+    pipeline = TelemetryPipeline(model_cache.load_model())
+    server = await (serve_udp if protocol == "udp" else serve_tcp)(pipeline, host, port)
+    task = asyncio.create_task(pipeline.run())
+
+    count = await send_log(path, host, port, protocol, rate, limit)
+    deadline = asyncio.get_running_loop().time() + timeout
+
+    while pipeline.latency["total"].count + pipeline.dropped + pipeline.errors < count and not task.done():
+        if asyncio.get_running_loop().time() > deadline:
+            print(f"{count - pipeline.latency['total'].count - pipeline.dropped - pipeline.errors} records lost")
+            break
+
+        await asyncio.sleep(0.01)
+
+    server.close()
+
+    if task.done():
+        # Re-raises the exception of a failed stage
+        task.result()
+
+    task.cancel()
+
+    return pipeline
+
+
+async def _listen(protocol, host, port, interval):
+    pipeline = TelemetryPipeline(model_cache.load_model())
+    await (serve_udp if protocol == "udp" else serve_tcp)(pipeline, host, port)
+    task = asyncio.create_task(pipeline.run())
+
+    while True:
+        await asyncio.sleep(interval)
+
+        if task.done():
+            task.result()
+
+        print(f"x={pipeline.filt.x[:, 0]} {pipeline.stats()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("mode", choices=["listen", "send", "demo"])
+    parser.add_argument("log", nargs="?", default="./ekf/data/flightlog3.csv")
+    parser.add_argument("--protocol", choices=["udp", "tcp"], default="udp")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5760)
+    parser.add_argument("--rate", type=float, default=1 / simulation.dt)
+    parser.add_argument("--limit", type=int)
+    args = parser.parse_args()
+
+    if args.mode == "listen":
+        asyncio.run(_listen(args.protocol, args.host, args.port, 1.0))
+    elif args.mode == "send":
+        print(asyncio.run(send_log(args.log, args.host, args.port, args.protocol, args.rate, args.limit)), "records sent")
+    else:
+        pipeline = asyncio.run(_demo(args.log, args.protocol, args.host, args.port, args.rate, args.limit))
+
+        for name, item in pipeline.stats().items():
+            print(f"{name}: {item}")
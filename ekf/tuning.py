@@ -0,0 +1,151 @@
+import glob
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from . import flightlog, model_cache, simulation
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+PARAMETERS = ["variance_gps", "variance_baro_height", "sigma_h"]
+
+_worker = {}
+
+
+# ================== EVALUATION ==================
+
+
+def _init_worker():
+    _worker["handles"] = model_cache.load_model()
+    _worker["logs"] = {}
+
+
+def _measurements(path):
+    if path not in _worker["logs"]:
+        _worker["logs"][path] = flightlog.altitude_measurements(flightlog.load_flight_log(path))
+
+    return _worker["logs"][path]
+
+
+def run_filter(handles, meas, variance_gps, variance_baro_height, sigma_h):
+    params = {"variance_gps": variance_gps, "variance_baro_height": variance_baro_height, "sigma_h": sigma_h}
+    result = simulation.run_filter(handles, meas, params)
+
+    innovations = {"gps": result["innovations_gps"][:, 1:], "baro": result["innovations_baro"][:, 1:]}
+    gps_baro = (meas["gps_height"] - meas["baro_height"])[meas["gps_fresh"]]
+
+    metrics = {}
+
+    for name, values in innovations.items():
+        metrics[f"nis_{name}"] = float(np.mean(values[:, 0] ** 2 / values[:, 1])) if len(values) else float("nan")
+        metrics[f"rms_{name}"] = float(np.sqrt(np.mean(values[:, 0] ** 2))) if len(values) else float("nan")
+
+    metrics["rms_gps_baro"] = float(np.sqrt(np.mean(np.square(gps_baro)))) if len(gps_baro) else float("nan")
+
+    return metrics
+
+
+def score(metrics, rms_weight=0.1):
+    # Scalar measurements have an expected NIS of 1, so a consistent filter scores |log(NIS)| = 0
+    consistency = abs(np.log(metrics["nis_gps"])) + abs(np.log(metrics["nis_baro"]))
+    residual = (metrics["rms_gps"] + metrics["rms_baro"]) / max(metrics["rms_gps_baro"], 1e-9)
+
+    return float(consistency + rms_weight * residual)
+
+
+def _complete(params):
+    # Candidates may tune a subset, the other parameters keep their replay defaults
+    return {k: params.get(k, simulation.DEFAULT_PARAMS[k]) for k in PARAMETERS}
+
+
+def _evaluate(task):
+    params, path = task
+    params = _complete(params)
+
+    return run_filter(_worker["handles"], _measurements(path), *[params[k] for k in PARAMETERS])
+
+
+# ================== SEARCH ==================
+
+
+def _check_names(names):
+    unknown = sorted(set(names) - set(PARAMETERS))
+
+    if unknown:
+        raise ValueError(f"unknown parameters {unknown}, expected a subset of {PARAMETERS}")
+
+
+def grid(**axes):
+    _check_names(axes)
+
+    names = [k for k in PARAMETERS if k in axes]
+
+    return [dict(zip(names, values)) for values in itertools.product(*[axes[k] for k in names])]
+
+
+def random_candidates(bounds, count, seed=0):
+    # Variances span orders of magnitude, so they are sampled log-uniformly
+    _check_names(bounds)
+
+    rng = np.random.default_rng(seed)
+
+    return [{k: float(np.exp(rng.uniform(np.log(lo), np.log(hi)))) for k, (lo, hi) in bounds.items()} for _ in range(count)]
+
+
+def tune(candidates, log_paths=None, processes=None, rms_weight=0.1, pool=None):
+    log_paths = log_paths or sorted(glob.glob(os.path.join(DATA_DIR, "*.csv")))
+    tasks = [(params, path) for params in candidates for path in log_paths]
+    chunksize = max(1, len(tasks) // (4 * (processes or os.cpu_count() or 1)))
+
+    if pool is None:
+        with ProcessPoolExecutor(processes, initializer=_init_worker) as pool:
+            results = list(pool.map(_evaluate, tasks, chunksize=chunksize))
+    else:
+        results = list(pool.map(_evaluate, tasks, chunksize=chunksize))
+
+    ranked = []
+
+    for i, params in enumerate(candidates):
+        per_log = dict(zip(log_paths, results[i * len(log_paths) : (i + 1) * len(log_paths)]))
+        total = float(np.mean([score(m, rms_weight) for m in per_log.values()]))
+
+        ranked.append({"params": params, "score": total, "logs": per_log})
+
+    ranked.sort(key=lambda x: x["score"])
+
+    return ranked
+
+
+def pattern_search(start, log_paths=None, iterations=10, step=4.0, processes=None, rms_weight=0.1):
+    # Log-space compass search, each iteration evaluates all neighbours of the best point in parallel
+    _check_names(start)
+
+    best = tune([_complete(start)], log_paths, processes, rms_weight)[0]
+
+    with ProcessPoolExecutor(processes, initializer=_init_worker) as pool:
+        for _ in range(iterations):
+            neighbours = []
+
+            for k in PARAMETERS:
+                for factor in [step, 1 / step]:
+                    neighbours.append({**best["params"], k: best["params"][k] * factor})
+
+            candidate = tune(neighbours, log_paths, rms_weight=rms_weight, pool=pool)[0]
+
+            if candidate["score"] < best["score"]:
+                best = candidate
+            else:
+                step = step**0.5
+
+    return best
+
+
+if __name__ == "__main__":
+    candidates = grid(
+        variance_gps=[0.4, 1.6, 6.4],
+        variance_baro_height=[0.2, 0.9, 3.6],
+        sigma_h=[0.25, 1, 4],
+    )
+
+    for result in tune(candidates)[:5]:
+        print(f"{result['score']:.4f} {result['params']}")
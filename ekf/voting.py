@@ -1,8 +1,18 @@
+import numpy as np
+
+# Scales the median absolute deviation to a standard deviation for normally distributed noise
+MAD_SCALE = 1.4826
+
+
 class SensorVoting:
     def __init__(self, ranges: list, variances: list):
         self.ranges = ranges
         self.variances = variances
 
+        self._ranges = np.asarray(ranges, dtype=float)
+        self._weights = 1 / np.asarray(variances, dtype=float)
+        self._sigmas = np.sqrt(np.asarray(variances, dtype=float))
+
     def vote(self, data: list):
         assert len(data) == len(self.ranges)
 
@@ -16,7 +26,7 @@ class SensorVoting:
         d = 0
 
         for i in filtered_data_indices:
-            weight = 1 / self.variances[i]
+            weight = self._weights[i]
 
             n += data[i] * weight
             d += weight
@@ -26,5 +36,47 @@ class SensorVoting:
 
         return [result, totalVariance]
 
+    def vote_batch(self, data, outlier_threshold=None):
+        # data is (N, sensors), every sample is voted in one pass
+        data = np.asarray(data, dtype=float)
+
+        assert data.shape[-1] == len(self._ranges)
+
+        valid = np.abs(data) < self._ranges
+
+        if outlier_threshold is not None:
+            valid &= ~self._outliers(data, valid, outlier_threshold)
+
+        weights = np.where(valid, self._weights, 0)
+        d = weights.sum(axis=-1)
+        n = (weights * np.where(valid, data, 0)).sum(axis=-1)
+
+        result = np.divide(n, d, out=np.zeros_like(d), where=d != 0)
+        totalVariance = np.divide(1, d, out=np.zeros_like(d), where=d != 0)
+
+        return [result, totalVariance]
+
+    def _outliers(self, data, valid, threshold):
+        # A sensor is rejected when it is further than threshold robust sigmas from the median of the valid sensors,
+        # its own noise sets a floor so sensors that agree exactly do not reject small differences
+        median = _masked_median(data, valid)
+        deviation = np.abs(data - median[..., None])
+        mad = _masked_median(deviation, valid)
+
+        sigma = np.maximum(MAD_SCALE * mad[..., None], self._sigmas)
+
+        return deviation > threshold * sigma
+
     def _is_sensor_saturated(self, value, range):
         return abs(value) >= range
+
+
+def _masked_median(data, mask):
+    # Invalid entries sort to the end as NaN, the median is taken over the first count entries of each row
+    values = np.sort(np.where(mask, data, np.nan), axis=-1)
+    count = mask.sum(axis=-1)
+
+    low = np.take_along_axis(values, np.maximum((count - 1) // 2, 0)[..., None], axis=-1)[..., 0]
+    high = np.take_along_axis(values, np.maximum(count // 2, 0)[..., None], axis=-1)[..., 0]
+
+    return np.where(count > 0, (low + high) / 2, 0)
@@ -4,14 +4,27 @@ Resources:
     - https://www.ngdc.noaa.gov/geomag/CalcSurveyFin.shtml
 """
 
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import hashlib
 import math
 import json
 import os
+import time
+import urllib.parse
 import urllib.request
+import numpy as np
+from . import mag
 
-BASE_URL = "https://www.ngdc.noaa.gov/geomag-web/calculators/calculateIgrfgrid"
+BASE_URL = os.environ.get("NOAA_BASE_URL", "https://www.ngdc.noaa.gov/geomag-web/calculators/calculateIgrfgrid")
 KEY = "gFE5W"
 
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "generated", "noaa_cache")
+MAX_WORKERS = 8
+RETRIES = 4
+RETRY_DELAY = 1.0
+TIMEOUT = 30
+
 SAMPLING_RES = 10
 SAMPLING_MIN_LAT = -90
 SAMPLING_MAX_LAT = 90
@@ -21,49 +34,102 @@ SAMPLING_MAX_LON = 180
 LAT_DIM = int((SAMPLING_MAX_LAT - SAMPLING_MIN_LAT) / SAMPLING_RES) + 1
 LON_DIM = int((SAMPLING_MAX_LON - SAMPLING_MIN_LON) / SAMPLING_RES) + 1
 
+# Table name: (NOAA component, result field)
+COMPONENTS = {
+    "declination": ("d", "declination"),
+    "inclination": ("i", "inclination"),
+    "strength": ("f", "totalintensity"),
+}
+
+
+# ================== FETCHING ==================
+
+
+def _query(component, latitude, res=SAMPLING_RES):
+    return {
+        "key": KEY,
+        "lat1": latitude,
+        "lat2": latitude,
+        "lon1": SAMPLING_MIN_LON,
+        "lon2": SAMPLING_MAX_LON,
+        "latStepSize": 1,
+        "lonStepSize": res,
+        "magneticComponent": component,
+        "resultFormat": "json",
+    }
+
+
+def _cache_path(cache_dir, base_url, params):
+    # The API key is left out so a new key does not invalidate responses that are already cached
+    query = urllib.parse.urlencode(sorted((k, v) for k, v in params.items() if k != "key"))
+
+    return os.path.join(cache_dir, hashlib.sha256(f"{base_url}?{query}".encode()).hexdigest()[:32] + ".json")
+
+
+def _fetch(base_url, params, cache_dir, retries, timeout):
+    path = _cache_path(cache_dir, base_url, params)
 
-def _get_data(component, key):
-    table = []
-    index = 0
+    if os.path.exists(path):
+        with open(path) as file:
+            return json.load(file)
 
-    for latitude in range(SAMPLING_MIN_LAT, SAMPLING_MAX_LAT + 1, SAMPLING_RES):
-        params = urllib.parse.urlencode(
-            {
-                "key": KEY,
-                "lat1": latitude,
-                "lat2": latitude,
-                "lon1": SAMPLING_MIN_LON,
-                "lon2": SAMPLING_MAX_LON,
-                "latStepSize": 1,
-                "lonStepSize": SAMPLING_RES,
-                "magneticComponent": component,
-                "resultFormat": "json",
-            }
-        )
+    for attempt in range(retries + 1):
+        try:
+            with urllib.request.urlopen(base_url + "?%s" % urllib.parse.urlencode(params), timeout=timeout) as f:
+                data = json.loads(f.read())
 
-        f = urllib.request.urlopen(BASE_URL + "?%s" % params)
-        data = json.loads(f.read())
+            break
+        except (OSError, ValueError):
+            if attempt == retries:
+                raise
 
-        table.append([])
+            time.sleep(RETRY_DELAY * 2**attempt)
 
-        for p in data["result"]:
-            table[index].append(p[key])
+    tmp_path = f"{path}.{os.getpid()}.{id(params)}.tmp"
 
-        index += 1
+    with open(tmp_path, "w") as file:
+        json.dump(data, file)
 
-    return table
+    os.replace(tmp_path, path)
 
+    return data
 
-def _get_declination():
-    return _get_data("d", "declination")
 
+def fetch_tables(
+    base_url=BASE_URL,
+    cache_dir=CACHE_DIR,
+    max_workers=MAX_WORKERS,
+    retries=RETRIES,
+    timeout=TIMEOUT,
+    res=SAMPLING_RES,
+    min_lat=SAMPLING_MIN_LAT,
+    max_lat=SAMPLING_MAX_LAT,
+):
+    # Every latitude row of every component is an independent request, finished rows stay cached when others fail
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
 
-def _get_inclination():
-    return _get_data("i", "inclination")
+    latitudes = range(min_lat, max_lat + 1, res)
 
+    with ThreadPoolExecutor(max_workers) as pool:
+        futures = {
+            name: [pool.submit(_fetch, base_url, _query(component, latitude, res), cache_dir, retries, timeout) for latitude in latitudes]
+            for name, (component, _) in COMPONENTS.items()
+        }
 
-def _get_strength():
-    return _get_data("f", "totalintensity")
+        errors = [f.exception() for rows in futures.values() for f in rows if f.exception() is not None]
+
+    if errors:
+        raise RuntimeError(f"{len(errors)} of {len(latitudes) * len(COMPONENTS)} requests failed, rerun to resume from the cache") from errors[0]
+
+    return {name: [[p[COMPONENTS[name][1]] for p in f.result()["result"]] for f in rows] for name, rows in futures.items()}
+
+
+# ================== CODE ==================
+
+
+def _encode_table(table, unit):
+    return [[int(round(math.radians(v) * 10000)) if "radians" in unit else int(round(v / 10)) for v in row] for row in table]
 
 
 def _generate_table_code(table, name, unit):
@@ -75,9 +141,7 @@ def _generate_table_code(table, name, unit):
         code += "\t{"
 
         for j in range(len(table[i])):
-            v = int(round(math.radians(table[i][j]) * 10000)) if "radians" in unit else int(round(table[i][j] / 10))
-
-            code += str(v) + ", "
+            code += str(table[i][j]) + ", "
 
         code += "},\n"
 
@@ -86,7 +150,7 @@ def _generate_table_code(table, name, unit):
     return code
 
 
-def generate_code():
+def generate_code(base_url=BASE_URL, cache_dir=CACHE_DIR, max_workers=MAX_WORKERS, retries=RETRIES):
     path = os.path.dirname(os.path.abspath(__file__))
     file_dir = os.path.join(path, "generated")
 
@@ -95,6 +159,13 @@ def generate_code():
 
     file_path = os.path.join(file_dir, "mag_tables.h")
 
+    data = fetch_tables(base_url, cache_dir, max_workers, retries)
+    tables = {
+        "declination": _encode_table(data["declination"], "radians"),
+        "inclination": _encode_table(data["inclination"], "radians"),
+        "strength": _encode_table(data["strength"], "Gauss"),
+    }
+
     with open(file_path, "w") as file:
         file.write(f"#ifndef _MAG_TABLES_H\n#define _MAG_TABLES_H\n\n")
         file.write(f"#include <stdint.h>\n\n")
@@ -106,11 +177,31 @@ def generate_code():
         file.write(f"#define LAT_DIM {LAT_DIM}\n")
         file.write(f"#define LON_DIM {LON_DIM}\n")
         file.write("\n")
-        file.write(f"{_generate_table_code(_get_declination(), 'declination', 'radians * 10^4')}\n")
-        file.write(f"{_generate_table_code(_get_inclination(), 'inclination', 'radians * 10^4')}\n")
-        file.write(f"{_generate_table_code(_get_strength(), 'strength', 'Gauss * 10^4')}\n")
+        file.write(f"{_generate_table_code(tables['declination'], 'declination', 'radians * 10^4')}\n")
+        file.write(f"{_generate_table_code(tables['inclination'], 'inclination', 'radians * 10^4')}\n")
+        file.write(f"{_generate_table_code(tables['strength'], 'strength', 'Gauss * 10^4')}\n")
         file.write(f"#endif")
 
+    # Binary copy of the same int16 tables for geo.mag, so Python does not have to parse the header
+    mag.write_cache(
+        {
+            "SAMPLING_RES": SAMPLING_RES,
+            "SAMPLING_MIN_LAT": SAMPLING_MIN_LAT,
+            "SAMPLING_MAX_LAT": SAMPLING_MAX_LAT,
+            "SAMPLING_MIN_LON": SAMPLING_MIN_LON,
+            "SAMPLING_MAX_LON": SAMPLING_MAX_LON,
+            **{k: np.array(v, dtype=np.int16) for k, v in tables.items()},
+        },
+        os.path.join(file_dir, mag.CACHE_FILE),
+    )
+
 
 if __name__ == "__main__":
-    generate_code()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base-url", default=BASE_URL)
+    parser.add_argument("--cache-dir", default=CACHE_DIR)
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS)
+    parser.add_argument("--retries", type=int, default=RETRIES)
+    args = parser.parse_args()
+
+    generate_code(args.base_url, args.cache_dir, args.workers, args.retries)
@@ -6,7 +6,9 @@ Resources:
     - https://www.movable-type.co.uk/scripts/latlong.html
 """
 
-from math import pi, sin, cos, sqrt, atan, atan2, asin, radians, degrees
+import math
+import numpy as np
+from numpy import pi, sin, cos, sqrt, arctan2 as atan2, radians, degrees
 
 
 a = 6378137.0
@@ -21,21 +23,44 @@ f = 1 / 298.257223563
 
 
 def _convert_coords_to_rad(coords_list):
-    new_coords = []
+    return [radians(np.asarray(x, dtype=float)) for x in coords_list]
 
-    for x in coords_list:
-        new_coords.append(radians(x))
 
-    return new_coords
+def _convert_coords_to_deg(coords_list):
+    return [degrees(np.asarray(x, dtype=float)) for x in coords_list]
 
 
-def _convert_coords_to_deg(coords_list):
-    new_coords = []
+def _as_result(value):
+    if isinstance(value, list):
+        return [_as_result(x) for x in value]
+
+    return float(value) if np.ndim(value) == 0 else value
+
+
+SCALAR_TYPES = {int, float, np.float64, np.float32, np.int64, np.int32}
+
 
-    for x in coords_list:
-        new_coords.append(degrees(x))
+def _is_scalar(*values):
+    # Plain numbers take the math module paths, NumPy ufuncs cost several microseconds per call on them
+    for x in values:
+        if type(x) not in SCALAR_TYPES:
+            return False
 
-    return new_coords
+    return True
+
+
+def _rotation_scalar(lat0, lon0):
+    sin_lat = math.sin(lat0)
+    cos_lat = math.cos(lat0)
+    sin_lon = math.sin(lon0)
+    cos_lon = math.cos(lon0)
+
+    # Rows map ECEF offsets to N, E, D; the transpose maps NED back to ECEF
+    return [
+        [-sin_lat * cos_lon, -sin_lat * sin_lon, cos_lat],
+        [-sin_lon, cos_lon, 0.0],
+        [-cos_lat * cos_lon, -cos_lat * sin_lon, -sin_lat],
+    ]
 
 
 # ================== GEO ==================
@@ -44,43 +69,107 @@ def _convert_coords_to_deg(coords_list):
 # REF: https://en.wikipedia.org/wiki/Geographic_coordinate_conversion#From_geodetic_to_ECEF_coordinates
 # REF: https://www.mathworks.com/help/map/ref/geodetic2ecef.html
 def geo_to_ecef(lat, lon, alt):
+    if _is_scalar(lat, lon, alt):
+        return _geo_to_ecef_scalar(float(lat), float(lon), float(alt))
+
     n = a / sqrt(1 - e2 * sin(lat) ** 2)
 
     x = (n + alt) * cos(lat) * cos(lon)
     y = (n + alt) * cos(lat) * sin(lon)
     z = ((1 - e2) * n + alt) * sin(lat)
 
-    return [x, y, z]
+    return _as_result([x, y, z])
 
 
-# REF: https://www.mathworks.com/help/aeroblks/ecefpositiontolla.html
-# REF: https://www.mathworks.com/help/map/ref/geodetic2ecef.html
+def _geo_to_ecef_scalar(lat, lon, alt):
+    sin_lat = math.sin(lat)
+    cos_lat = math.cos(lat)
+    n = a / math.sqrt(1 - e2 * sin_lat * sin_lat)
+
+    return [(n + alt) * cos_lat * math.cos(lon), (n + alt) * cos_lat * math.sin(lon), ((1 - e2) * n + alt) * sin_lat]
+
+
+# REF: https://doi.org/10.1007/s00190-010-0419-x (Vermeille, An analytical method to transform geocentric into geodetic coordinates)
 # REF: https://en.wikipedia.org/wiki/Geographic_coordinate_conversion#From_ECEF_to_geodetic_coordinates
-def ecef_to_geo(x, y, z):
-    lon = atan2(y, x)
+def ecef_to_geo_scalar(x, y, z):
+    # Closed form, a fixed number of operations for every point
+    p = (x * x + y * y) / a**2
+    q = (1 - e2) * z * z / a**2
+    r = (p + q - e2**2) / 6
+    c = e2**2 * p * q
+    ev = 8 * r**3 + c
+
+    if ev > 0:
+        u = r + 0.5 * (math.sqrt(ev) + math.sqrt(c)) ** (2 / 3) + 0.5 * abs(math.sqrt(ev) - math.sqrt(c)) ** (2 / 3)
+    else:
+        # Inside the evolute, within about 43 km of the center of the Earth, the largest of three real roots
+        psi = 2 * math.atan2(math.sqrt(c), math.sqrt(-ev))
+        u = -4 * r * math.sin(psi / 6) * math.sin(pi / 3 - psi / 6)
+
+    v = math.sqrt(u * u + e2**2 * q)
+
+    # Equatorial plane inside the evolute, the equator normal passes through the point
+    if v == 0:
+        return [0.0, math.atan2(y, x), math.hypot(x, y) - a]
+
+    w = e2 * (u + v - q) / (2 * v)
+    k = (u + v) / (math.sqrt(w * w + u + v) + w)
+    d = k * math.hypot(x, y) / (k + e2)
+    dz = math.hypot(d, z)
+
+    return [2 * math.atan2(z, dz + d), math.atan2(y, x), (k + e2 - 1) / k * dz]
+
 
-    s = sqrt(x**2 + y**2)
+def ecef_to_geo_array(x, y, z):
+    # Same closed form as ecef_to_geo_scalar on arrays, both branches are evaluated and selected per point
+    x, y, z = np.broadcast_arrays(*[np.asarray(v, dtype=float) for v in [x, y, z]])
 
-    beta = atan(z / ((1 - f) * s))
-    miu = atan((z + e2 * (1 - f) / (1 - e2) * a * sin(beta) ** 3) / (s - e2 * a * cos(beta) ** 3))
-    err = 1e10
+    p = (x * x + y * y) / a**2
+    q = (1 - e2) * z * z / a**2
+    r = (p + q - e2**2) / 6
+    c = e2**2 * p * q
+    ev = 8 * r**3 + c
+    outside = ev > 0
 
-    while err > 1e-10:
-        beta = atan((1 - f) * sin(miu) / cos(miu))
-        last_miu = miu
-        miu = atan((z + e2 * (1 - f) / (1 - e2) * a * sin(beta) ** 3) / (s - e2 * a * cos(beta) ** 3))
-        err = last_miu - miu
+    sqrt_c = sqrt(c)
+    sqrt_ev = sqrt(np.abs(ev))
+    psi = 2 * atan2(sqrt_c, sqrt_ev)
 
-    n = a / sqrt(1 - e2 * sin(miu) ** 2)
-    h = s * cos(miu) + (z + e2 * n * sin(miu)) * sin(miu) - n
+    u = np.where(
+        outside,
+        r + 0.5 * np.cbrt((sqrt_ev + sqrt_c) ** 2) + 0.5 * np.cbrt((sqrt_ev - sqrt_c) ** 2),
+        -4 * r * sin(psi / 6) * sin(pi / 3 - psi / 6),
+    )
 
-    return [miu, lon, h]
+    v = sqrt(u * u + e2**2 * q)
+    equatorial = v == 0
+    v = np.where(equatorial, 1.0, v)
+
+    w = e2 * (u + v - q) / (2 * v)
+    k = (u + v) / (sqrt(w * w + u + v) + w)
+    d = k * np.hypot(x, y) / (k + e2)
+    dz = np.hypot(d, z)
+
+    lat = np.where(equatorial, 0.0, 2 * atan2(z, dz + d))
+    h = np.where(equatorial, np.hypot(x, y) - a, (k + e2 - 1) / k * dz)
+
+    return [lat, atan2(y, x), h]
+
+
+def ecef_to_geo(x, y, z):
+    if _is_scalar(x, y, z) or (np.ndim(x) == 0 and np.ndim(y) == 0 and np.ndim(z) == 0):
+        return ecef_to_geo_scalar(float(x), float(y), float(z))
+
+    return ecef_to_geo_array(x, y, z)
 
 
 # REF: https://en.wikipedia.org/wiki/Geographic_coordinate_conversion#From_ECEF_to_ENU
 # REF: https://en.wikipedia.org/wiki/Local_tangent_plane_coordinates
 # REF: https://www.mathworks.com/help/map/ref/ecef2ned.html
 def ecef_to_ned(x, y, z, lat0, lon0, alt0):
+    if _is_scalar(x, y, z, lat0, lon0, alt0):
+        return _ecef_to_ned_scalar(float(x), float(y), float(z), float(lat0), float(lon0), float(alt0))
+
     [x0, y0, z0] = geo_to_ecef(lat0, lon0, alt0)
 
     dx = x - x0
@@ -91,13 +180,27 @@ def ecef_to_ned(x, y, z, lat0, lon0, alt0):
     y_ned = dx * (-sin(lon0)) + dy * (cos(lon0)) + dz * (0)
     z_ned = dx * (-cos(lat0) * cos(lon0)) + dy * (-cos(lat0) * sin(lon0)) + dz * (-sin(lat0))
 
-    return [x_ned, y_ned, z_ned]
+    return _as_result([x_ned, y_ned, z_ned])
+
+
+def _ecef_to_ned_scalar(x, y, z, lat0, lon0, alt0):
+    [[r00, r01, r02], [r10, r11, r12], [r20, r21, r22]] = _rotation_scalar(lat0, lon0)
+    [x0, y0, z0] = _geo_to_ecef_scalar(lat0, lon0, alt0)
+
+    dx = x - x0
+    dy = y - y0
+    dz = z - z0
+
+    return [r00 * dx + r01 * dy + r02 * dz, r10 * dx + r11 * dy + r12 * dz, r20 * dx + r21 * dy + r22 * dz]
 
 
 # REF: https://en.wikipedia.org/wiki/Geographic_coordinate_conversion#From_ENU_to_ECEF
 # REF: https://en.wikipedia.org/wiki/Local_tangent_plane_coordinates
 # REF: https://www.mathworks.com/help/map/ref/ned2ecef.html
 def ned_to_ecef(x, y, z, lat0, lon0, alt0):
+    if _is_scalar(x, y, z, lat0, lon0, alt0):
+        return _ned_to_ecef_scalar(float(x), float(y), float(z), float(lat0), float(lon0), float(alt0))
+
     [x0, y0, z0] = geo_to_ecef(lat0, lon0, alt0)
 
     x_ecef = x * (-sin(lat0) * cos(lon0)) + y * (-sin(lon0)) + z * (-cos(lat0) * cos(lon0))
@@ -108,28 +211,107 @@ def ned_to_ecef(x, y, z, lat0, lon0, alt0):
     y_ecef += y0
     z_ecef += z0
 
-    return [x_ecef, y_ecef, z_ecef]
+    return _as_result([x_ecef, y_ecef, z_ecef])
+
+
+def _ned_to_ecef_scalar(x, y, z, lat0, lon0, alt0):
+    [[r00, r01, r02], [r10, r11, r12], [r20, r21, r22]] = _rotation_scalar(lat0, lon0)
+    [x0, y0, z0] = _geo_to_ecef_scalar(lat0, lon0, alt0)
+
+    return [r00 * x + r10 * y + r20 * z + x0, r01 * x + r11 * y + r21 * z + y0, r02 * x + r12 * y + r22 * z + z0]
 
 
 # REF: https://www.mathworks.com/help/map/ref/geodetic2ned.html
 def geo_to_ned(lat0, lon0, alt0, lat1, lon1, alt1):
+    if _is_scalar(lat0, lon0, alt0, lat1, lon1, alt1):
+        [x1, y1, z1] = _geo_to_ecef_scalar(math.radians(lat1), math.radians(lon1), float(alt1))
+
+        return _ecef_to_ned_scalar(x1, y1, z1, math.radians(lat0), math.radians(lon0), float(alt0))
+
     [lat0, lon0, lat1, lon1] = _convert_coords_to_rad([lat0, lon0, lat1, lon1])
 
     [x1, y1, z1] = geo_to_ecef(lat1, lon1, alt1)
     [x, y, z] = ecef_to_ned(x1, y1, z1, lat0, lon0, alt0)
 
-    return [x, y, z]
+    return _as_result([x, y, z])
 
 
 # REF: https://www.mathworks.com/help/map/ref/ned2geodetic.html
 def ned_to_geo(lat0, lon0, alt0, x, y, z):
+    if _is_scalar(lat0, lon0, alt0, x, y, z):
+        [x_ecef, y_ecef, z_ecef] = _ned_to_ecef_scalar(float(x), float(y), float(z), math.radians(lat0), math.radians(lon0), float(alt0))
+        [lat, lon, alt] = ecef_to_geo_scalar(x_ecef, y_ecef, z_ecef)
+
+        return [math.degrees(lat), math.degrees(lon), alt]
+
     [lat0, lon0] = _convert_coords_to_rad([lat0, lon0])
 
     [x_ecef, y_ecef, z_ecef] = ned_to_ecef(x, y, z, lat0, lon0, alt0)
     [lat, lon, alt] = ecef_to_geo(x_ecef, y_ecef, z_ecef)
     [lat, lon] = _convert_coords_to_deg([lat, lon])
 
-    return [lat, lon, alt]
+    return _as_result([lat, lon, alt])
+
+
+# ================== LOCAL FRAME ==================
+
+
+# REF: https://en.wikipedia.org/wiki/Local_tangent_plane_coordinates
+class LocalFrame:
+    def __init__(self, lat0, lon0, alt0):
+        self.lat0 = lat0
+        self.lon0 = lon0
+        self.alt0 = alt0
+
+        lat0 = math.radians(lat0)
+        lon0 = math.radians(lon0)
+
+        self.origin = _geo_to_ecef_scalar(lat0, lon0, float(alt0))
+        self.rotation = _rotation_scalar(lat0, lon0)
+
+    def to_ned(self, x, y, z):
+        [[r00, r01, r02], [r10, r11, r12], [r20, r21, r22]] = self.rotation
+        [x0, y0, z0] = self.origin
+
+        dx = x - x0
+        dy = y - y0
+        dz = z - z0
+
+        return [
+            r00 * dx + r01 * dy + r02 * dz,
+            r10 * dx + r11 * dy + r12 * dz,
+            r20 * dx + r21 * dy + r22 * dz,
+        ]
+
+    def from_ned(self, x, y, z):
+        [[r00, r01, r02], [r10, r11, r12], [r20, r21, r22]] = self.rotation
+        [x0, y0, z0] = self.origin
+
+        return [
+            r00 * x + r10 * y + r20 * z + x0,
+            r01 * x + r11 * y + r21 * z + y0,
+            r02 * x + r12 * y + r22 * z + z0,
+        ]
+
+    def geo_to_ned(self, lat, lon, alt):
+        # A scalar fix is a subtract and a 3x3 multiply on plain floats
+        if _is_scalar(lat, lon, alt):
+            return self.to_ned(*_geo_to_ecef_scalar(math.radians(lat), math.radians(lon), float(alt)))
+
+        [lat, lon] = _convert_coords_to_rad([lat, lon])
+
+        return _as_result(self.to_ned(*geo_to_ecef(lat, lon, alt)))
+
+    def ned_to_geo(self, x, y, z):
+        if _is_scalar(x, y, z):
+            [lat, lon, alt] = ecef_to_geo_scalar(*self.from_ned(float(x), float(y), float(z)))
+
+            return [math.degrees(lat), math.degrees(lon), alt]
+
+        [lat, lon, alt] = ecef_to_geo(*self.from_ned(x, y, z))
+        [lat, lon] = _convert_coords_to_deg([lat, lon])
+
+        return _as_result([lat, lon, alt])
 
 
 # ================== OTHER ==================
@@ -138,6 +320,9 @@ def ned_to_geo(lat0, lon0, alt0, x, y, z):
 # REF: https://github.com/PX4/PX4-ECL/blob/master/geo/geo.cpp
 # REF: https://www.movable-type.co.uk/scripts/latlong.html
 def geo_distance(lat0, lon0, lat1, lon1):
+    if _is_scalar(lat0, lon0, lat1, lon1):
+        return _geo_distance_scalar(math.radians(lat0), math.radians(lon0), math.radians(lat1), math.radians(lon1))
+
     [lat0, lon0, lat1, lon1] = _convert_coords_to_rad([lat0, lon0, lat1, lon1])
 
     d_lat = lat1 - lat0
@@ -146,12 +331,24 @@ def geo_distance(lat0, lon0, lat1, lon1):
     a = sin(d_lat / 2) * sin(d_lat / 2) + sin(d_lon / 2) * sin(d_lon / 2) * cos(lat0) * cos(lat1)
     c = 2 * atan2(sqrt(a), sqrt(1 - a))
 
-    return r * c
+    return _as_result(r * c)
+
+
+def _geo_distance_scalar(lat0, lon0, lat1, lon1):
+    sin_d_lat = math.sin((lat1 - lat0) / 2)
+    sin_d_lon = math.sin((lon1 - lon0) / 2)
+
+    a = sin_d_lat * sin_d_lat + sin_d_lon * sin_d_lon * math.cos(lat0) * math.cos(lat1)
+
+    return r * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
 
 
 # REF: https://github.com/PX4/PX4-ECL/blob/master/geo/geo.cpp
 # REF: https://www.movable-type.co.uk/scripts/latlong.html
 def geo_bearing(lat0, lon0, lat1, lon1):
+    if _is_scalar(lat0, lon0, lat1, lon1):
+        return _geo_bearing_scalar(math.radians(lat0), math.radians(lon0), math.radians(lat1), math.radians(lon1))
+
     [lat0, lon0, lat1, lon1] = _convert_coords_to_rad([lat0, lon0, lat1, lon1])
 
     cos_lat1 = cos(lat1)
@@ -162,11 +359,24 @@ def geo_bearing(lat0, lon0, lat1, lon1):
     theta = atan2(y, x)
     bearing = (theta + 2 * pi) % (2 * pi)
 
-    return bearing
+    return _as_result(bearing)
+
+
+def _geo_bearing_scalar(lat0, lon0, lat1, lon1):
+    cos_lat1 = math.cos(lat1)
+    d_lon = lon1 - lon0
+
+    y = math.sin(d_lon) * cos_lat1
+    x = math.cos(lat0) * math.sin(lat1) - math.sin(lat0) * cos_lat1 * math.cos(d_lon)
+
+    return (math.atan2(y, x) + 2 * pi) % (2 * pi)
 
 
 def baro_formula(press):
-    return 44330.76923 * (1 - ((press / 101325) ** 0.1902632))
+    if type(press) in SCALAR_TYPES:
+        return 44330.76923 * (1 - (float(press) / 101325) ** 0.1902632)
+
+    return _as_result(44330.76923 * (1 - ((np.asarray(press, dtype=float) / 101325) ** 0.1902632)))
 
 
 # ================== TEST CASES ==================
@@ -180,5 +390,36 @@ if __name__ == "__main__":
     print(ned_to_ecef(1334.3044602, -2544.36768413, 359.96087162, radians(44.532), radians(-72.782), 1699))
     print(geo_to_ned(44.532, -72.782, 1699, 44.544, -72.814, 1340))
     print(ned_to_geo(44.532, -72.782, 1699, 1334.3044602, -2544.36768413, 359.96087162))
+    print(LocalFrame(44.532, -72.782, 1699).geo_to_ned(44.544, -72.814, 1340))
+    print(LocalFrame(44.532, -72.782, 1699).ned_to_geo(1334.3044602, -2544.36768413, 359.96087162))
     print(geo_distance(44.532, -72.782, 44.544, -72.814))
     print(degrees(geo_bearing(44.532, -72.782, 44.544, -72.814)))
+
+    # ecef_to_geo round trip over a global grid of altitudes, max error and throughput
+    import time
+
+    grid = np.meshgrid(
+        radians(np.linspace(-90, 90, 361)),
+        radians(np.linspace(-180, 180, 721)),
+        [-12000, -100, 0, 1, 100, 1000, 1e4, 1e5, 4e5, 3.6e7],
+        indexing="ij",
+    )
+    ecef = geo_to_ecef(*grid)
+
+    start = time.perf_counter()
+    [lat, lon, alt] = ecef_to_geo(*ecef)
+    array_time = time.perf_counter() - start
+
+    points = list(zip(*[x.ravel()[::100].tolist() for x in ecef]))
+    start = time.perf_counter()
+
+    for point in points:
+        ecef_to_geo(*point)
+
+    scalar_time = (time.perf_counter() - start) / len(points)
+
+    print(f"points: {lat.size}")
+    print(f"max lat error: {np.max(np.abs(lat - grid[0])) * a:.3e} m")
+    print(f"max lon error: {np.max(np.abs(np.angle(np.exp(1j * (lon - grid[1])))) * np.cos(grid[0])) * a:.3e} m")
+    print(f"max alt error: {np.max(np.abs(alt - grid[2])):.3e} m")
+    print(f"array: {lat.size / array_time / 1e6:.2f} M points/s, scalar: {scalar_time * 1e6:.2f} us/point")
@@ -0,0 +1,151 @@
+"""
+Resources:
+    - https://github.com/PX4/PX4-ECL/blob/master/geo_lookup/geo_mag_declination.cpp
+    - https://www.ngdc.noaa.gov/geomag/CalcSurveyFin.shtml
+"""
+
+import os
+import re
+import numpy as np
+from numpy import sin, cos
+from . import geo
+
+GENERATED_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "generated")
+HEADER_FILE = "mag_tables.h"
+CACHE_FILE = "mag_tables.npz"
+
+TABLES = ["declination", "inclination", "strength"]
+GRID = ["SAMPLING_RES", "SAMPLING_MIN_LAT", "SAMPLING_MAX_LAT", "SAMPLING_MIN_LON", "SAMPLING_MAX_LON"]
+
+# Table units are radians * 10^4 and Gauss * 10^4
+SCALE = 1e-4
+
+_tables = {}
+
+
+# ================== LOADING ==================
+
+
+def parse_header(path):
+    with open(path) as file:
+        source = file.read()
+
+    tables = {name: int(value) for name, value in re.findall(r"#define (\w+) (-?\d+)", source)}
+
+    for name in TABLES:
+        body = re.search(name.upper() + r"_TABLE\[LAT_DIM\]\[LON_DIM\] = \{(.*?)\};", source, re.S).group(1)
+        rows = re.findall(r"\{([^{}]*)\}", body)
+
+        tables[name] = np.array([[int(v) for v in row.split(",") if v.strip()] for row in rows], dtype=np.int16)
+
+        # Compressed tables from mag_table_gen store int8 steps from a per-row int16 offset
+        if name.upper() + "_STEP" in tables:
+            body = re.search(name.upper() + r"_OFFSET\[LAT_DIM\] = \{(.*?)\};", source, re.S).group(1)
+            offset = np.array([int(v) for v in body.split(",") if v.strip()])
+
+            tables[name] = offset[:, None] + tables[name.upper() + "_STEP"] * tables[name].astype(int)
+
+    return tables
+
+
+def write_cache(tables, path=os.path.join(GENERATED_DIR, CACHE_FILE)):
+    tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+
+    np.savez(tmp_path, **{k: tables[k] for k in [*GRID, *TABLES]})
+    os.replace(tmp_path, path)
+
+
+def load_tables(path=GENERATED_DIR):
+    # Parsed once per process, the binary cache is only used while it is newer than the header
+    if path in _tables:
+        return _tables[path]
+
+    header = os.path.join(path, HEADER_FILE)
+    cache = os.path.join(path, CACHE_FILE)
+
+    if os.path.exists(cache) and (not os.path.exists(header) or os.path.getmtime(cache) >= os.path.getmtime(header)):
+        with np.load(cache) as data:
+            tables = {k: data[k] if k in TABLES else int(data[k]) for k in data.files}
+    else:
+        tables = parse_header(header)
+
+    _tables[path] = tables
+
+    return tables
+
+
+# ================== LOOKUP ==================
+
+
+def _table_index(value, min_value, res, dim):
+    # Only the cell's lower corner is clamped, like get_lookup_table_index in PX4, the interpolation scale still comes
+    # from the coordinate itself, so the last row and column cells interpolate up to the table edge
+    return np.clip(np.floor((value - min_value) / res), 0, dim - 2).astype(np.intp)
+
+
+# REF: https://github.com/PX4/PX4-ECL/blob/master/geo_lookup/geo_mag_declination.cpp
+def get_table_data(lat, lon, table, tables=None):
+    tables = tables or load_tables()
+    res = tables["SAMPLING_RES"]
+    min_lat = tables["SAMPLING_MIN_LAT"]
+    min_lon = tables["SAMPLING_MIN_LON"]
+    max_lon = tables["SAMPLING_MAX_LON"]
+
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    lon = np.where(lon > max_lon, lon - 360, lon)
+    lon = np.where(lon < min_lon, lon + 360, lon)
+
+    data = np.asarray(tables[table], dtype=float)
+
+    i = _table_index(lat, min_lat, res, data.shape[0])
+    j = _table_index(lon, min_lon, res, data.shape[1])
+
+    data_sw = data[i, j]
+    data_se = data[i, j + 1]
+    data_ne = data[i + 1, j + 1]
+    data_nw = data[i + 1, j]
+
+    lat_scale = np.clip((lat - (i * res + min_lat)) / res, 0, 1)
+    lon_scale = np.clip((lon - (j * res + min_lon)) / res, 0, 1)
+
+    data_min = lon_scale * (data_se - data_sw) + data_sw
+    data_max = lon_scale * (data_ne - data_nw) + data_nw
+
+    return lat_scale * (data_max - data_min) + data_min
+
+
+def get_mag_declination(lat, lon):
+    return geo._as_result(get_table_data(lat, lon, "declination") * SCALE)
+
+
+def get_mag_inclination(lat, lon):
+    return geo._as_result(get_table_data(lat, lon, "inclination") * SCALE)
+
+
+def get_mag_strength(lat, lon):
+    return geo._as_result(get_table_data(lat, lon, "strength") * SCALE)
+
+
+# REF: https://github.com/PX4/PX4-ECL/blob/master/EKF/mag_fusion.cpp
+def get_mag_field_ned(lat, lon):
+    tables = load_tables()
+
+    declination = get_table_data(lat, lon, "declination", tables) * SCALE
+    inclination = get_table_data(lat, lon, "inclination", tables) * SCALE
+    strength = get_table_data(lat, lon, "strength", tables) * SCALE
+
+    return geo._as_result(
+        [
+            strength * cos(inclination) * cos(declination),
+            strength * cos(inclination) * sin(declination),
+            strength * sin(inclination),
+        ]
+    )
+
+
+if __name__ == "__main__":
+    print(np.degrees(get_mag_declination(44.532, -72.782)))
+    print(np.degrees(get_mag_inclination(44.532, -72.782)))
+    print(get_mag_strength(44.532, -72.782))
+    print(get_mag_field_ned([44.532, 52.2297], [-72.782, 21.0122]))
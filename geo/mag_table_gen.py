@@ -0,0 +1,285 @@
+"""
+Resources:
+    - https://github.com/PX4/PX4-ECL/blob/master/geo_lookup/geo_mag_declination.cpp
+    - https://www.ngdc.noaa.gov/geomag/CalcSurveyFin.shtml
+"""
+
+import argparse
+import os
+import numpy as np
+from . import fetch_noaa_table, mag
+
+# Grid steps that divide both 180 and 360 degrees
+RESOLUTIONS = [1, 2, 3, 4, 5, 6, 9, 10, 12, 15, 18, 20, 30]
+ENCODINGS = ["int16", "int8_delta"]
+
+REFERENCE_RES = 1
+
+UNITS = {
+    "declination": "radians * 10^4",
+    "inclination": "radians * 10^4",
+    "strength": "Gauss * 10^4",
+}
+
+
+# ================== REFERENCE ==================
+
+
+def fetch_reference(res=REFERENCE_RES, **fetch_args):
+    data = fetch_noaa_table.fetch_tables(res=res, **fetch_args)
+
+    return {
+        "res": res,
+        "declination": np.radians(np.array(data["declination"], dtype=float)),
+        "inclination": np.radians(np.array(data["inclination"], dtype=float)),
+        "strength": np.array(data["strength"], dtype=float) * 1e-5,
+    }
+
+
+# ================== ENCODING ==================
+
+
+def _band(res, min_lat, max_lat):
+    # Operating band rounded outwards onto the grid of this resolution
+    min_band = fetch_noaa_table.SAMPLING_MIN_LAT + int(np.floor((min_lat - fetch_noaa_table.SAMPLING_MIN_LAT) / res)) * res
+    max_band = fetch_noaa_table.SAMPLING_MIN_LAT + int(np.ceil((max_lat - fetch_noaa_table.SAMPLING_MIN_LAT) / res)) * res
+
+    return min_band, min(max_band, fetch_noaa_table.SAMPLING_MAX_LAT)
+
+
+def _quantize(values):
+    # Same rounding as fetch_noaa_table._encode_table
+    return np.round(values * 1e4).astype(np.int16)
+
+
+def _encode_int8_delta(table):
+    # Each row stores an int16 midpoint and int8 steps from it, one step size per table
+    low = table.min(axis=1).astype(int)
+    high = table.max(axis=1).astype(int)
+    offset = ((low + high) // 2).astype(np.int16)
+    step = max(1, int(np.ceil(np.max(np.maximum(high - offset, offset - low)) / 127)))
+    values = np.clip(np.round((table - offset[:, None]) / step), -127, 127).astype(np.int8)
+
+    return {"offset": offset, "step": step, "values": values}
+
+
+def _decode_int8_delta(encoded):
+    return encoded["offset"][:, None] + encoded["step"] * encoded["values"].astype(int)
+
+
+def encode(reference, res, encoding, min_lat=-90, max_lat=90):
+    k = res // reference["res"]
+    min_band, max_band = _band(res, min_lat, max_lat)
+    rows = slice((min_band - fetch_noaa_table.SAMPLING_MIN_LAT) // reference["res"], (max_band - fetch_noaa_table.SAMPLING_MIN_LAT) // reference["res"] + 1, k)
+
+    candidate = {
+        "encoding": encoding,
+        "SAMPLING_RES": res,
+        "SAMPLING_MIN_LAT": min_band,
+        "SAMPLING_MAX_LAT": max_band,
+        "SAMPLING_MIN_LON": fetch_noaa_table.SAMPLING_MIN_LON,
+        "SAMPLING_MAX_LON": fetch_noaa_table.SAMPLING_MAX_LON,
+        "encoded": {},
+        "bytes": 0,
+    }
+
+    for name in mag.TABLES:
+        table = _quantize(reference[name][rows, ::k])
+
+        if encoding == "int16":
+            candidate["encoded"][name] = {"values": table}
+            candidate[name] = table
+            candidate["bytes"] += table.size * 2
+        else:
+            encoded = _encode_int8_delta(table)
+
+            candidate["encoded"][name] = encoded
+            candidate[name] = _decode_int8_delta(encoded)
+            candidate["bytes"] += table.size + len(table) * 2
+
+    return candidate
+
+
+def measure_error(reference, candidate, min_lat=-90, max_lat=90):
+    # Errors at every reference grid point of the operating band, through the same lookup as the C side
+    lat = np.arange(reference[mag.TABLES[0]].shape[0]) * reference["res"] + fetch_noaa_table.SAMPLING_MIN_LAT
+    lon = np.arange(reference[mag.TABLES[0]].shape[1]) * reference["res"] + fetch_noaa_table.SAMPLING_MIN_LON
+    rows = (lat >= min_lat) & (lat <= max_lat)
+    lat, lon = np.meshgrid(lat[rows], lon, indexing="ij")
+
+    errors = {}
+
+    for name in mag.TABLES:
+        error = mag.get_table_data(lat, lon, name, candidate) * mag.SCALE - reference[name][rows]
+
+        errors[name] = {"max": float(np.max(np.abs(error))), "rms": float(np.sqrt(np.mean(error**2)))}
+
+    return errors
+
+
+def select_table(reference, max_error, flash_budget, min_lat=-90, max_lat=90, resolutions=RESOLUTIONS, encodings=ENCODINGS):
+    # Smallest table that meets every per-table max error within the flash budget
+    candidates = []
+
+    for res in resolutions:
+        if res % reference["res"] != 0:
+            continue
+
+        for encoding in encodings:
+            candidate = encode(reference, res, encoding, min_lat, max_lat)
+            candidate["errors"] = measure_error(reference, candidate, min_lat, max_lat)
+
+            candidates.append(candidate)
+
+    fits = [c for c in candidates if c["bytes"] <= flash_budget and all(c["errors"][k]["max"] <= max_error[k] for k in mag.TABLES)]
+
+    if not fits:
+        best = [c for c in candidates if c["bytes"] <= flash_budget]
+        best = min(best or candidates, key=lambda c: max(c["errors"][k]["max"] / max_error[k] for k in mag.TABLES))
+
+        raise ValueError(
+            f"No table meets the error target within {flash_budget} bytes, "
+            f"closest is {best['SAMPLING_RES']} deg {best['encoding']} ({best['bytes']} bytes): {best['errors']}"
+        )
+
+    return min(fits, key=lambda c: (c["bytes"], sum(c["errors"][k]["rms"] / max_error[k] for k in mag.TABLES))), candidates
+
+
+# ================== CODE ==================
+
+
+def _array_code(ctype, name, dims, values):
+    code = f"static const {ctype} {name}{dims} = {{\n"
+
+    if values.ndim == 1:
+        code += "\t" + "".join(f"{v}, " for v in values) + "\n"
+    else:
+        for row in values:
+            code += "\t{" + "".join(f"{v}, " for v in row) + "},\n"
+
+    code += "};\n"
+
+    return code
+
+
+# REF: https://github.com/PX4/PX4-ECL/blob/master/geo_lookup/geo_mag_declination.cpp
+LOOKUP_CODE = """static inline float get_{name}_data(float lat, float lon)
+{{
+\tif (lon > SAMPLING_MAX_LON)
+\t\tlon -= 360;
+
+\tif (lon < SAMPLING_MIN_LON)
+\t\tlon += 360;
+
+\t// Only the cell's lower corner is clamped, the scale comes from the coordinate itself
+\tint i = (int)floorf((lat - SAMPLING_MIN_LAT) / SAMPLING_RES);
+\tint j = (int)floorf((lon - SAMPLING_MIN_LON) / SAMPLING_RES);
+
+\ti = i < 0 ? 0 : (i > LAT_DIM - 2 ? LAT_DIM - 2 : i);
+\tj = j < 0 ? 0 : (j > LON_DIM - 2 ? LON_DIM - 2 : j);
+
+\tconst float data_sw = {value}(i, j);
+\tconst float data_se = {value}(i, j + 1);
+\tconst float data_ne = {value}(i + 1, j + 1);
+\tconst float data_nw = {value}(i + 1, j);
+
+\tfloat lat_scale = (lat - (float)(i * SAMPLING_RES + SAMPLING_MIN_LAT)) / SAMPLING_RES;
+\tfloat lon_scale = (lon - (float)(j * SAMPLING_RES + SAMPLING_MIN_LON)) / SAMPLING_RES;
+
+\tlat_scale = lat_scale < 0 ? 0 : (lat_scale > 1 ? 1 : lat_scale);
+\tlon_scale = lon_scale < 0 ? 0 : (lon_scale > 1 ? 1 : lon_scale);
+
+\tconst float data_min = lon_scale * (data_se - data_sw) + data_sw;
+\tconst float data_max = lon_scale * (data_ne - data_nw) + data_nw;
+
+\treturn lat_scale * (data_max - data_min) + data_min;
+}}
+"""
+
+
+def generate_table_code(candidate):
+    lat_dim = len(candidate[mag.TABLES[0]])
+    lon_dim = len(candidate[mag.TABLES[0]][0])
+
+    code = "#ifndef _MAG_TABLES_H\n#define _MAG_TABLES_H\n\n"
+    code += "#include <math.h>\n#include <stdint.h>\n\n"
+
+    for key in mag.GRID:
+        code += f"#define {key} {candidate[key]}\n"
+
+    code += f"#define LAT_DIM {lat_dim}\n"
+    code += f"#define LON_DIM {lon_dim}\n"
+    code += "\n"
+
+    for name in mag.TABLES:
+        encoded = candidate["encoded"][name]
+        upper = name.upper()
+
+        if candidate["encoding"] == "int16":
+            code += f"// Magnetic {name} in {UNITS[name]}\n"
+            code += _array_code("int16_t", f"{upper}_TABLE", "[LAT_DIM][LON_DIM]", encoded["values"])
+            code += f"#define {upper}_VALUE(i, j) ((float){upper}_TABLE[i][j])\n\n"
+        else:
+            code += f"// Magnetic {name} in {UNITS[name]}, row offset plus step times table value\n"
+            code += f"#define {upper}_STEP {encoded['step']}\n"
+            code += _array_code("int16_t", f"{upper}_OFFSET", "[LAT_DIM]", encoded["offset"])
+            code += _array_code("int8_t", f"{upper}_TABLE", "[LAT_DIM][LON_DIM]", encoded["values"])
+            code += f"#define {upper}_VALUE(i, j) ((float)({upper}_OFFSET[i] + {upper}_STEP * {upper}_TABLE[i][j]))\n\n"
+
+    for name in mag.TABLES:
+        code += LOOKUP_CODE.format(name=name, value=f"{name.upper()}_VALUE") + "\n"
+
+    code += "#endif\n"
+
+    return code
+
+
+def report(candidate):
+    lines = [f"{candidate['SAMPLING_RES']} deg {candidate['encoding']}, lat {candidate['SAMPLING_MIN_LAT']}..{candidate['SAMPLING_MAX_LAT']}, {candidate['bytes']} bytes"]
+
+    for name in mag.TABLES:
+        lines.append(f"    {name}: max error {candidate['errors'][name]['max']:.3e}, rms error {candidate['errors'][name]['rms']:.3e}")
+
+    return "\n".join(lines)
+
+
+def generate_code(max_error, flash_budget, min_lat=-90, max_lat=90, file_name="mag_tables.h", **fetch_args):
+    reference = fetch_reference(**fetch_args)
+    candidate, _ = select_table(reference, max_error, flash_budget, min_lat, max_lat)
+
+    file_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "generated")
+
+    if not os.path.exists(file_dir):
+        os.makedirs(file_dir)
+
+    with open(os.path.join(file_dir, file_name), "w") as file:
+        file.write(generate_table_code(candidate))
+
+    mag.write_cache(candidate, os.path.join(file_dir, os.path.splitext(file_name)[0] + ".npz"))
+
+    print(report(candidate))
+
+    return candidate
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max-angle-error", type=float, default=0.5, help="degrees")
+    parser.add_argument("--max-strength-error", type=float, default=0.005, help="Gauss")
+    parser.add_argument("--flash", type=int, default=4096, help="bytes")
+    parser.add_argument("--min-lat", type=float, default=-90)
+    parser.add_argument("--max-lat", type=float, default=90)
+    parser.add_argument("--base-url", default=fetch_noaa_table.BASE_URL)
+    args = parser.parse_args()
+
+    generate_code(
+        {
+            "declination": np.radians(args.max_angle_error),
+            "inclination": np.radians(args.max_angle_error),
+            "strength": args.max_strength_error,
+        },
+        args.flash,
+        args.min_lat,
+        args.max_lat,
+        base_url=args.base_url,
+    )